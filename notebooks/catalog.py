@@ -0,0 +1,199 @@
+"""Local snapshot of the cloud catalog, with fast lookups
+
+   cloud_catalog() keeps the noQC catalog csv as a parquet file and only downloads the csv
+   again when the server reports a new ETag/Last-Modified. CatalogIndex answers zstore and
+   facet queries from hash tables instead of scanning the whole DataFrame.
+   update_catalog() brings an old catalog up to date with the stores in the bucket (nb3b).
+"""
+
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import requests
+
+from identify import get_versions
+from errata import worst
+from fileio import write_atomic, write_json
+
+noqc_url = 'https://cmip6.storage.googleapis.com/cmip6-zarr-consolidated-stores-noQC.csv'
+
+facet_keys = ['activity_id','institution_id','source_id','experiment_id','member_id','table_id','variable_id','grid_label']
+
+def cloud_catalog(url=noqc_url, cache_dir='cache/catalog', max_age=3600, refresh=False, verbose=False):
+    '''the catalog csv at url as a DataFrame (all columns str, as read_csv with dtype='unicode')'''
+    # The snapshot is used without asking the server if it was checked less than max_age seconds
+    # ago; otherwise a conditional GET only downloads the csv if it has changed.
+    os.makedirs(cache_dir, exist_ok=True)
+    name = os.path.basename(url).rsplit('.', 1)[0]
+    data_file = f'{cache_dir}/{name}.parquet'
+    meta_file = f'{cache_dir}/{name}.json'
+
+    meta = {}
+    if os.path.isfile(meta_file) and os.path.isfile(data_file) and not refresh:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if time.time() - meta['checked'] < max_age:
+            if verbose:
+                print('catalog snapshot from', time.ctime(meta['fetched']))
+            return _read_snapshot(data_file)
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True, timeout=(10, 300)) as r:
+        if r.status_code == 304:
+            if verbose:
+                print('catalog unchanged since', meta.get('last_modified'))
+            meta['checked'] = time.time()
+            write_json(meta_file, meta)
+            return _read_snapshot(data_file)
+        r.raise_for_status()
+        csv_file = f'{cache_dir}/{name}.csv'
+        def download(tmp):
+            with open(tmp, 'wb') as f:
+                for block in r.iter_content(chunk_size=2**20):
+                    f.write(block)
+        write_atomic(csv_file, download)
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+
+    if verbose:
+        print('downloaded new catalog, last modified', last_modified)
+    df = pd.read_csv(csv_file, dtype='unicode')
+    os.remove(csv_file)
+    write_atomic(data_file, lambda tmp: df.to_parquet(tmp, index=False))
+    now = time.time()
+    meta = dict(url=url, etag=etag, last_modified=last_modified, fetched=now, checked=now)
+    write_json(meta_file, meta)
+    return df
+
+def _read_snapshot(data_file):
+    df = pd.read_parquet(data_file)
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].notna(), np.nan)   # parquet gives None, read_csv NaN
+    return df
+
+class CatalogIndex:
+    '''rows of a catalog by zstore and by facets'''
+    # by_facets - the 8 facets -> row positions; by_value - each facet value -> row positions,
+    # intersected for queries on some of the facets
+
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+        zstores = self.df.zstore.values
+        self.by_zstore = {zstore: n for n, zstore in reversed(list(enumerate(zstores)))}
+        keys = [key for key in facet_keys if key in self.df.columns]
+        self.keys = keys
+        self.by_facets = self.df.groupby(keys, sort=False).indices
+        self.by_value = {key: self.df.groupby(key, sort=False).indices for key in keys}
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, zstore):
+        return zstore in self.by_zstore
+
+    def get(self, zstore):
+        '''catalog row of zstore (None if not there)'''
+        n = self.by_zstore.get(zstore)
+        return None if n is None else self.df.iloc[n]
+
+    def lookup(self, **facets):
+        '''rows matching the facets (a value or a list of values each)'''
+        if sorted(facets) == sorted(self.keys) and all(isinstance(v, str) for v in facets.values()):
+            rows = self.by_facets.get(tuple(facets[key] for key in self.keys), [])
+            return self.df.iloc[rows]
+        rows = None
+        for key, values in facets.items():
+            if isinstance(values, str):
+                values = [values]
+            found = [self.by_value[key][value] for value in values if value in self.by_value[key]]
+            found = np.unique(np.concatenate(found)) if len(found) > 0 else np.array([], dtype=int)
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        return self.df if rows is None else self.df.iloc[rows]
+
+def stores_to_df(zstores):
+    '''catalog rows (8 facets, zstore, dcpp_init_year) for zstores gs://cmip6/activity_id/.../grid_label/'''
+    zstores = list(zstores)
+    dz = pd.DataFrame([zstore.split('/')[-9:-1] for zstore in zstores], columns=facet_keys, dtype=object)
+    bad = dz.variable_id == dz.grid_label
+    assert not bad.any(), 'must fix: ' + ', '.join(np.array(zstores)[bad.values])
+    dz['zstore'] = zstores
+    dcpp = dz.member_id.str.startswith('s').astype(bool)
+    dz['dcpp_init_year'] = np.where(dcpp, dz.member_id.str.split('-').str[0].str[1:], np.nan).astype(float)
+    dz['member_id'] = np.where(dcpp, dz.member_id.str.split('-').str[-1], dz.member_id)
+    return dz
+
+status_columns = ['status','severity','issue_url']
+
+def errata_status(dz, dz_exclude):
+    '''status, severity and issue_url of each row of dz from its most serious issue in the errata
+       (by vstore = zstore + version)'''
+    vstore = dz.zstore + 'v' + dz.version.astype(str)
+    de = worst(dz_exclude).set_index('vstore')
+    return pd.DataFrame({'status': vstore.map(de.status).fillna('good'),
+                         'severity': vstore.map(de.severity).fillna('none'),
+                         'issue_url': vstore.map(de.issue_url).fillna('none')})
+
+def update_catalog(dz_old, zstores, dz_exclude, resolve=get_versions, recheck=(), verbose=True):
+    '''the noQC catalog dz_old brought up to date with the zstores now in the bucket
+
+       recheck - stores (e.g. just uploaded) whose version is found again even if dz_old has one
+       returns (dz_new, changes) - changes counts the (zstore, version) rows added and removed,
+       the versions found, the stores with a changed errata status and those without a version
+    '''
+    # Only the differences with dz_old are worked on: stores no longer listed are dropped,
+    # new stores are parsed from their paths, and versions are only resolved (resolve - as
+    # identify.get_versions) for new stores, rechecked ones and those with unknown versions.
+    # A store whose version can't be found keeps its old version; a new one is left out
+    # (and tried again next time). The errata status of all rows comes from a single join with dz_exclude.
+    in_bucket = pd.Index(pd.unique(pd.Series(list(zstores), dtype=object)))
+    keep = dz_old.zstore.isin(in_bucket).values
+    new = stores_to_df(in_bucket.difference(pd.Index(dz_old.zstore), sort=False))
+    new['version'] = np.nan
+    dz = pd.concat([dz_old[keep], new], ignore_index=True)
+
+    unknown = (dz.version == 'ambiguous') | dz.version.isna() | dz.zstore.isin(list(recheck))
+    failed = pd.DataFrame(columns=['zstore', 'error'])
+    versioned = 0
+    if unknown.any():
+        dv = resolve(dz[unknown].zstore.values)
+        failed = dv[dv.error != ''][['zstore', 'error']]
+        found = dv[dv.error == '']
+        update = unknown & dz.zstore.isin(found.zstore)
+        dz.loc[update, 'version'] = dz[update].zstore.map(dict(zip(found.zstore, found.version))).values
+        versioned = int(update.sum())
+        dz = dz[~(dz.zstore.isin(failed.zstore) & dz.version.isna())].reset_index(drop=True)
+        if verbose:
+            for zstore, error in failed.values:
+                print('no version for', zstore, error)
+
+    status = errata_status(dz, dz_exclude)
+    for col in status_columns:
+        dz[col] = status[col].values
+
+    # the deltas are (zstore, version) rows: a new version of a store replaces its old row
+    old_keys = pd.MultiIndex.from_arrays([dz_old.zstore, dz_old.version.astype(str)])
+    new_keys = pd.MultiIndex.from_arrays([dz.zstore, dz.version.astype(str)])
+    reflagged = 0
+    if all(col in dz_old.columns for col in status_columns):
+        old = dz_old[status_columns].fillna('').set_index(old_keys)
+        old = old[~old.index.duplicated()]
+        both = new_keys.isin(old.index)
+        reflagged = int((old.loc[new_keys[both]].values != status[both].values).any(axis=1).sum())
+
+    changes = dict(added=int((~new_keys.isin(old_keys)).sum()), removed=int((~old_keys.isin(new_keys)).sum()),
+                   versioned=versioned, reflagged=reflagged, failed=len(failed))
+    if verbose:
+        print(changes)
+    return dz[list(dz_old.columns) + [col for col in dz.columns if col not in dz_old.columns]], changes
+
+def write_catalog(df, file):
+    '''write the catalog csv atomically (a reader never sees half a catalog)'''
+    write_atomic(file, lambda tmp: df.to_csv(tmp, index=False))
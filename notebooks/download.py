@@ -0,0 +1,339 @@
+"""Parallel, resumable downloads of ESGF netcdf files
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import threading
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+import pandas as pd
+
+from fileio import write_atomic, JsonCache
+
+def _host(url):
+    return urlsplit(url).netloc
+
+# one pooled session per data node
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _get_session(host, pool_size=4):
+    with _sessions_lock:
+        client = _sessions.get(host)
+        if client is None:
+            client = requests.session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            client.mount('https://', adapter)
+            client.mount('http://', adapter)
+            _sessions[host] = client
+    return client
+
+class HostStats(JsonCache):
+    '''throughput and error rate of each data node'''
+    # rates are exponentially weighted (weight decay for the history) so a node can recover.
+    # A node is slow once min_samples downloads have been seen and its rate is below
+    # min_rate bytes/s or more than max_error_rate of its downloads fail; it is given
+    # another chance retry_after seconds after its last download.
+
+    def __init__(self, file='cache/host_stats.json', min_rate=50e3, max_error_rate=0.5,
+                 min_samples=3, decay=0.7, retry_after=24*3600):
+        super().__init__(file, indent=1)
+        self.retry_after = retry_after
+        self.min_rate = min_rate
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.decay = decay
+        self._slots = {}
+
+    def semaphore(self, host, per_host):
+        '''the connection slots of a node, shared by all downloads using these stats'''
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.slots(host, per_host))
+            return self._slots[host]
+
+    def record(self, result):
+        '''add the outcome of one download_file call'''
+        failed = result['status'] != 'downloaded'
+        rate = result['bytes'] / max(result['seconds'], 1e-3)
+        with self._lock:
+            h = self.values.setdefault(result['host'], dict(rate=None, error_rate=0., samples=0,
+                                                            bytes=0, seconds=0., last=None))
+            d = self.decay if h['samples'] > 0 else 0.
+            # failures count against the rate only if nothing useful came through
+            if not failed or result['bytes'] > 0:
+                h['rate'] = rate if h['rate'] is None else d*h['rate'] + (1-d)*rate
+            h['error_rate'] = d*h['error_rate'] + (1-d)*float(failed)
+            h['samples'] += 1
+            h['bytes'] += result['bytes']
+            h['seconds'] += result['seconds']
+            h['last'] = time.time()
+
+    def rate(self, host):
+        h = self.values.get(host)
+        return None if h is None else h['rate']
+
+    def is_slow(self, host):
+        h = self.values.get(host)
+        if h is None or h['samples'] < self.min_samples:
+            return False
+        if time.time() - h['last'] > self.retry_after:
+            return False
+        if h['error_rate'] > self.max_error_rate:
+            return True
+        return h['rate'] is not None and h['rate'] < self.min_rate
+
+    def slots(self, host, per_host):
+        '''connections allowed to a node: nodes close to the slow limit get only one'''
+        rate = self.rate(host)
+        if rate is not None and rate < 4*self.min_rate:
+            return 1
+        return per_host
+
+    def rank(self, urls):
+        '''urls on usable nodes, fastest first (nodes never seen before count as fast)'''
+        def speed(url):
+            rate = self.rate(_host(url))
+            return float('inf') if rate is None else rate
+        usable = [url for url in urls if not self.is_slow(_host(url))]
+        return sorted(usable, key=speed, reverse=True)
+
+class NcCache:
+    '''netcdf files kept by checksum, shared by all stores and runs'''
+    # Least recently used files are removed once the cache holds more than max_bytes, down to
+    # low_water of it, so a full cache is not scanned again after every download. The size is
+    # counted from one scan plus the files put since (other runs sharing the cache are only
+    # seen at the next eviction).
+    # Files are copied in and out (not linked), so removing or changing a file in nctemp
+    # (after an upload, or by a 'files' fix) never touches the cached copy.
+
+    def __init__(self, cache_dir='cache/netcdf', max_bytes=50e9, low_water=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self._bytes = None      # not counted yet
+
+    def path(self, checksum):
+        return f'{self.cache_dir}/{checksum[:2]}/{checksum}.nc'
+
+    def get(self, checksum, save_file):
+        '''copy the cached file to save_file, if there is one'''
+        if checksum is None or pd.isna(checksum):
+            return False
+        cached = self.path(checksum)
+        try:
+            os.utime(cached)    # mark as recently used
+        except FileNotFoundError:
+            return False
+        write_atomic(save_file, lambda tmp: shutil.copyfile(cached, tmp))
+        return True
+
+    def put(self, file, checksum):
+        '''add a (verified) file'''
+        cached = self.path(checksum)
+        if os.path.isfile(cached):
+            os.utime(cached)
+            return
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        write_atomic(cached, lambda tmp: shutil.copyfile(file, tmp))
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += os.path.getsize(cached)
+            full = self._bytes is None or self._bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self):
+        '''count the cache and, if it holds more than max_bytes, remove the least recently used files'''
+        with self._lock:
+            files = [(os.path.getmtime(f), os.path.getsize(f), f)
+                     for f in glob(f'{self.cache_dir}/*/*.nc')]
+            total = sum(size for mtime, size, f in files)
+            target = self.max_bytes * self.low_water if total > self.max_bytes else total
+            for mtime, size, f in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._bytes = total
+
+def _new_hasher(checksum, checksum_type):
+    if checksum is None or pd.isna(checksum):
+        return None
+    return hashlib.new(str(checksum_type).lower().replace('-', ''))
+
+def _hash_file(file, hasher, block_size=2**22):
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher
+
+def file_ok(file, expected_size=None, checksum=None, checksum_type='SHA256'):
+    '''does a local file match the ESGF size and checksum?'''
+    if not os.path.isfile(file):
+        return False
+    if expected_size is not None and os.path.getsize(file) != int(expected_size):
+        return False
+    hasher = _new_hasher(checksum, checksum_type)
+    if hasher is not None:
+        return _hash_file(file, hasher).hexdigest() == checksum
+    return True
+
+def download_file(url, save_file, expected_size=None, checksum=None, checksum_type='SHA256',
+                  verify=True, timeout=(10, 120), chunk_size=2**20, min_rate=None, grace=60):
+    '''download url to save_file, resuming from save_file.part and checking the checksum on the fly'''
+    # min_rate - give up (keeping the .part file) if fewer bytes/s arrive after grace seconds
+    result = dict(url=url, file=save_file, host=_host(url), status='failed',
+                  bytes=0, seconds=0., error='')
+    part = save_file + '.part'
+    hasher = _new_hasher(checksum, checksum_type) if verify else None
+    start = time.time()
+    try:
+        have = os.path.getsize(part) if os.path.isfile(part) else 0
+        if verify and expected_size is not None and have >= int(expected_size):
+            # nothing sensible to resume (a range from the end would only get 416) - start over
+            os.remove(part)
+            have = 0
+
+        client = _get_session(result['host'])
+        for attempt in range(2):
+            headers = {}
+            if have > 0:
+                headers['Range'] = f'bytes={have}-'
+            with client.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416 and have > 0:
+                    # the .part file does not fit what the server has - start over from byte 0
+                    os.remove(part)
+                    have = 0
+                    continue
+                r.raise_for_status()
+                mode = 'ab' if (have > 0 and r.status_code == 206) else 'wb'
+                if mode == 'wb':
+                    have = 0        # no range support - start over
+                if hasher is not None and have > 0:
+                    _hash_file(part, hasher)
+                with open(part, mode) as f:
+                    for block in r.iter_content(chunk_size=chunk_size):
+                        f.write(block)
+                        result['bytes'] += len(block)
+                        if hasher is not None:
+                            hasher.update(block)
+                        elapsed = time.time() - start
+                        if min_rate is not None and elapsed > grace and result['bytes'] < min_rate*elapsed:
+                            raise IOError(f'too slow: {result["bytes"]/elapsed/1e3:.1f} kB/s')
+            break
+
+        size = os.path.getsize(part)
+        if verify and expected_size is not None and size != int(expected_size):
+            result['error'] = f'expected/actual size: {expected_size}/{size}'
+            if size > int(expected_size):
+                os.remove(part)
+        elif hasher is not None and hasher.hexdigest() != checksum:
+            result['error'] = f'checksum mismatch: {hasher.hexdigest()} != {checksum}'
+            os.remove(part)
+        else:
+            os.replace(part, save_file)
+            result['status'] = 'downloaded'
+    except (requests.RequestException, OSError) as e:
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    return result
+
+def candidate_urls(row):
+    # all known copies of the file (replica_urls, from search) or just HTTPServer_url
+    urls = row.get('replica_urls')
+    if isinstance(urls, str) or not hasattr(urls, '__len__') or len(urls) == 0:
+        urls = [row['HTTPServer_url']]
+    return list(urls)
+
+def download_files(df_files, save_dir='nctemp', max_workers=8, per_host=2, retries=2,
+                   verify=True, stats=None, cache=None, verbose=True):
+    '''download the files in df_files (file_name, HTTPServer_url, size and, if known, checksum)
+
+       returns a DataFrame with one row of results per file: status is one of
+       'exists' (already there and correct), 'cached' (copied from cache), 'downloaded',
+       'skipped' (only slow nodes) or 'failed'
+    '''
+    # Files with several copies (replica_urls) are fetched from the fastest node first; a failed,
+    # truncated or too slow download moves on to the next copy, resuming from the same .part file.
+    # Each copy is tried up to retries+1 times.
+    # stats - HostStats used to rank the copies, throttle and skip slow nodes
+    #         and abort downloads slower than stats.min_rate; None uses cache/host_stats.json
+    # cache - NcCache to take files from (by checksum) and to put verified downloads in
+    os.makedirs(save_dir, exist_ok=True)
+    if stats is None:
+        stats = HostStats()
+
+    # limit the number of simultaneous connections to each data node (across all the
+    # download_files calls sharing stats)
+    host_slots = {}
+    for index, row in df_files.iterrows():
+        for url in candidate_urls(row):
+            host = _host(url)
+            if host not in host_slots:
+                host_slots[host] = stats.semaphore(host, per_host)
+
+    def get(row):
+        save_file = os.path.join(save_dir, row['file_name'])
+        expected_size = row.get('size')
+        checksum = row.get('checksum')
+        checksum_type = row.get('checksum_type', 'SHA256')
+        if pd.isna(checksum_type):
+            checksum_type = 'SHA256'
+        urls = candidate_urls(row)
+
+        # noSizeCheck (verify=False): the sizes reported for these files are known to be wrong
+        if file_ok(save_file, expected_size if verify else None, checksum if verify else None, checksum_type):
+            return dict(url=urls[0], file=save_file, host=_host(urls[0]), status='exists',
+                        bytes=0, seconds=0., error='')
+
+        if cache is not None and verify and cache.get(checksum, save_file):
+            return dict(url=urls[0], file=save_file, host=_host(urls[0]), status='cached',
+                        bytes=0, seconds=0., error='')
+
+        ranked = stats.rank(urls)
+        if len(ranked) == 0:
+            return dict(url=urls[0], file=save_file, host=_host(urls[0]), status='skipped',
+                        bytes=0, seconds=0., error='slow data node')
+
+        attempts = 0
+        for attempt in range(retries + 1):
+            for url in ranked:
+                attempts += 1
+                with host_slots[_host(url)]:
+                    if verbose:
+                        print('downloading',url,' expected size: ',expected_size)
+                    result = download_file(url, save_file, expected_size=expected_size, checksum=checksum,
+                                           checksum_type=checksum_type, verify=verify,
+                                           min_rate=stats.min_rate)
+                stats.record(result)
+                if result['status'] == 'downloaded':
+                    break
+                if verbose:
+                    print('  failed:',result['error'])
+            if result['status'] == 'downloaded':
+                break
+        result['attempts'] = attempts
+        if (cache is not None and verify and result['status'] == 'downloaded'
+                and checksum is not None and not pd.isna(checksum)):
+            cache.put(save_file, checksum)
+        return result
+
+    rows = [row for index, row in df_files.iterrows()]
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(get, rows))
+    finally:
+        stats.save()
+
+    dr = pd.DataFrame(results)
+    dr.insert(0, 'file_name', [row['file_name'] for row in rows])
+    return dr
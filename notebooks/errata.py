@@ -0,0 +1,182 @@
+"""The ES-DOC errata as a table of affected datasets
+
+   read_issues() and read_dsets() load the issues/issue_<uid>.json and dsets/dset_<uid>.txt
+   files written by nb3a. errata_files() expands them into one row per (issue, dataset)
+   (the layout of csv/errata-files.csv) with all dataset ids split at once.
+   read_errata() reads that csv back with the zstore and vstore (zstore + 'v' + version)
+   of each dataset. affected() joins a catalog with it.
+   retrieve_issues() keeps the local issue and dset files up to date with ES-DOC.
+"""
+
+import os
+import json
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+
+from fileio import write_text, write_json
+
+issue_keys = ['uid', 'title', 'description', 'project', 'severity', 'status', 'urls']
+
+errata_keys = ['issue_uid','source_id','experiment_id','member_id','table_id','variable_id','grid_label',
+               'version','file_id','status','severity','issue_url']
+
+# from least to most serious
+severities = ['low', 'medium', 'high', 'critical']
+
+issue_url = 'https://errata.es-doc.org/static/view.html?uid='
+
+def read_issues(uids=None, issue_dir='issues'):
+    '''DataFrame of the issues (all issue_*.json in issue_dir if uids is None)'''
+    if uids is None:
+        uids = sorted(f.split('issue_')[-1][:-5] for f in glob(f'{issue_dir}/issue_*.json'))
+    issues = []
+    for uid in uids:
+        with open(f'{issue_dir}/issue_{uid}.json') as f:
+            issue = json.load(f)
+        issue.setdefault('urls', [])
+        issues += [issue]
+    df = pd.DataFrame(issues)
+    return df.reindex(columns=issue_keys + [key for key in df.columns if key not in issue_keys])
+
+def read_dsets(uids, dset_dir='dsets'):
+    '''DataFrame of issue_uid and file_id (CMIP6.activity_id. ... .grid_label#version) of the issues'''
+    # some lists have two dataset ids run together on one line; lines of other projects are dropped
+    lines, owners = [], []
+    for uid in uids:
+        file = f'{dset_dir}/dset_{uid}.txt'
+        if not os.path.isfile(file):
+            continue
+        with open(file) as f:
+            text = f.read().split()
+        lines += text
+        owners += [uid] * len(text)
+    ds = pd.DataFrame({'issue_uid': owners, 'file_id': lines}, dtype=object)
+    ds['file_id'] = ds.file_id.str.split(r'(?<=\d)(?=CMIP6\.)', regex=True)
+    ds = ds.explode('file_id', ignore_index=True)
+    ok = ds.file_id.str.startswith('CMIP6.') & (ds.file_id.str.count(r'\.') == 8) & ds.file_id.str.contains('#')
+    return ds[ok].reset_index(drop=True)
+
+def errata_files(df_issues, dset_dir='dsets'):
+    '''one row per issue and affected dataset, as csv/errata-files.csv'''
+    ds = read_dsets(df_issues.uid.values, dset_dir)
+    ds = ds.drop_duplicates(['issue_uid', 'file_id'])
+    parts = ds.file_id.str.split('.', expand=True)
+    grid_version = parts[8].str.split('#', expand=True)
+    de = pd.DataFrame({'issue_uid': ds.issue_uid.values,
+                       'source_id': parts[3].values, 'experiment_id': parts[4].values,
+                       'member_id': parts[5].values, 'table_id': parts[6].values,
+                       'variable_id': parts[7].values, 'grid_label': grid_version[0].values,
+                       'version': grid_version[1].values, 'file_id': ds.file_id.values})
+    di = df_issues.set_index('uid')
+    de['status'] = de.issue_uid.map(di.status).values
+    de['severity'] = de.issue_uid.map(di.severity).values
+    de['issue_url'] = issue_url + de.issue_uid
+    return de[errata_keys]
+
+def file_id_to_zstore(file_ids):
+    '''gs://cmip6/activity_id/.../grid_label/ of the dataset ids CMIP6.activity_id. ... .grid_label#version'''
+    file_ids = pd.Series(file_ids, dtype=object)
+    return ('gs://cmip6/' + file_ids.str.split('#').str[0].str[len('CMIP6.'):].str.replace('.', '/', regex=False)
+            + '/').values
+
+def read_errata(file='csv/errata-files.csv'):
+    '''the errata table with zstore and vstore columns'''
+    de = pd.read_csv(file, dtype={'version': str})
+    de['zstore'] = file_id_to_zstore(de.file_id)
+    de['vstore'] = de.zstore + 'v' + de.version
+    return de
+
+def affected(dz, de, how='inner'):
+    '''rows of catalog dz (zstore, version) joined with their issues in errata table de
+
+       a store appears once for each of its issues; how='left' keeps the stores without issues
+    '''
+    vstore = dz.zstore + 'v' + dz.version.astype(str)
+    cols = ['vstore', 'issue_uid', 'status', 'severity', 'issue_url']
+    dj = pd.DataFrame({'row': np.arange(len(dz)), 'vstore': vstore.values})
+    dj = dj.merge(de[cols].drop_duplicates(['vstore', 'issue_uid']), on='vstore', how=how)
+    out = dz.iloc[dj.row.values].drop(columns=[c for c in cols if c in dz.columns])
+    for key in cols:
+        out[key] = dj[key].values
+    return out
+
+def worst(de):
+    '''the most serious issue of each vstore in errata table de'''
+    rank = pd.Categorical(de.severity, categories=severities, ordered=True).codes
+    return de.iloc[np.argsort(-rank, kind='stable')].drop_duplicates('vstore')
+
+# ---- retrieving the issues from ES-DOC ----
+
+errata_api = 'https://errata.es-doc.org/1/issue'
+
+def _session(pool_size):
+    client = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    client.mount('https://', adapter)
+    client.mount('http://', adapter)
+    return client
+
+def _updated(issue):
+    return issue.get('date_updated', issue.get('dateUpdated'))
+
+def retrieve_issue(uid, issue_dir='issues', dset_dir='dsets', url=errata_api, client=None):
+    '''fetch one issue, writing issue_dir/issue_<uid>.json and dset_dir/dset_<uid>.txt'''
+    client = requests if client is None else client
+    r = client.get(f'{url}/retrieve', params={'uid': uid}, timeout=(10, 120))
+    r.raise_for_status()
+    issue = r.json()['issue']
+    dsets = issue.pop('datasets', [])
+    info = {key: issue[key] for key in issue_keys if issue.get(key) not in (None, [])}
+    write_json(f'{issue_dir}/issue_{uid}.json', info, indent=4)
+    write_text(f'{dset_dir}/dset_{uid}.txt', ''.join(dset + '\n' for dset in dsets))
+    return _updated(issue)
+
+def retrieve_issues(issues, issue_dir='issues', dset_dir='dsets', state_file='cache/errata_updated.json',
+                    url=errata_api, max_workers=8, verbose=True):
+    '''bring the local issue and dset files up to date with issues (the list of retrieve-all)
+
+       only the issues which are new or have a different date_updated than the last
+       time they were fetched are retrieved; returns a DataFrame of uid, result
+       ('unchanged', 'fetched' or 'failed') and error
+    '''
+    # state_file keeps the date_updated of each local issue. Issues without a
+    # date_updated in the list are always fetched.
+    for d in [issue_dir, dset_dir, os.path.dirname(state_file) or '.']:
+        os.makedirs(d, exist_ok=True)
+    state = {}
+    if os.path.isfile(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    def is_current(issue):
+        uid = issue['uid']
+        return (_updated(issue) is not None and state.get(uid) == _updated(issue)
+                and os.path.isfile(f'{issue_dir}/issue_{uid}.json') and os.path.isfile(f'{dset_dir}/dset_{uid}.txt'))
+
+    todo = [issue for issue in issues if not is_current(issue)]
+    client = _session(max_workers)
+
+    def get(issue):
+        try:
+            updated = retrieve_issue(issue['uid'], issue_dir, dset_dir, url=url, client=client)
+            return issue['uid'], 'fetched', '', _updated(issue) if updated is None else updated
+        except (requests.RequestException, OSError, ValueError, KeyError) as e:
+            return issue['uid'], 'failed', repr(e), None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(get, todo))
+
+    for uid, result, error, updated in results:
+        if result == 'fetched':
+            state[uid] = updated
+    write_json(state_file, state, indent=1)
+
+    fetched = {uid: (result, error) for uid, result, error, updated in results}
+    dr = pd.DataFrame([(issue['uid'],) + fetched.get(issue['uid'], ('unchanged', '')) for issue in issues],
+                      columns=['uid', 'result', 'error'])
+    if verbose:
+        print(dict(dr.result.value_counts()))
+    return dr
@@ -0,0 +1,71 @@
+"""Writing files atomically
+
+   write_atomic() and the write_text/write_json shortcuts never leave half a file behind:
+   the new contents go to a temp file of their own in the same directory, which then
+   replaces the file. Two writers of the same file never share a temp file.
+   JsonCache is the base of the small caches kept between runs in a json file.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+# the permissions a new file would get from open() (the temp files are created 0600)
+_umask = os.umask(0)
+os.umask(_umask)
+
+def write_atomic(path, write):
+    '''write(tmp) writes the new contents of path to the file tmp, which then replaces path'''
+    # The temp file is hidden (.name.xxx.tmp), so globs and parquet dataset reads skip it.
+    # The new file keeps the permissions of the old one (e.g. read-only shelf listings).
+    folder = os.path.dirname(path) or '.'
+    with tempfile.NamedTemporaryFile(dir=folder, prefix='.' + os.path.basename(path) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        tmp = f.name
+    try:
+        write(tmp)
+        if os.path.isfile(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o666 & ~_umask)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def write_text(path, text):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            f.write(text)
+    write_atomic(path, write)
+
+def write_json(path, value, **kwargs):
+    '''json.dump value to path (kwargs as for json.dump)'''
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(value, f, **kwargs)
+    write_atomic(path, write)
+
+class JsonCache:
+    '''a dict (values) kept between runs in a json file (file=None: not kept)'''
+    # put and save hold the lock, so threads can share one cache; save once when done,
+    # as it rewrites the whole file
+
+    def __init__(self, file, indent=None):
+        self.file = file
+        self.indent = indent
+        self._lock = threading.Lock()
+        self.values = {}
+        if file is not None and os.path.isfile(file):
+            with open(file) as f:
+                self.values = json.load(f)
+
+    def save(self):
+        if self.file is None:
+            return
+        os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+        with self._lock:
+            write_json(self.file, self.values, indent=self.indent)
@@ -0,0 +1,113 @@
+"""Fixes for the known troubles of some datasets (the reason_code of csv/exceptions.csv)
+
+   Each fix is registered under (part of) the code it handles and the stage it applies to:
+     'files'      - the list of netcdf files, e.g. dropping duplicates: fix(code, gfiles) -> gfiles
+     'preprocess' - each file as opened by open_mfdataset: fix(ds) -> ds
+     'dataset'    - the concatenated dataset: fix(code, ds, gfiles, svar) -> ds
+   A code may match several fixes; they are applied in the order they were registered.
+"""
+
+import os
+import numpy as np
+import xarray as xr
+import cftime
+
+stages = ['files', 'preprocess', 'dataset']
+
+# key (part of a reason_code) -> [(stage, function)]
+registry = {}
+
+def register(key, stage):
+    '''decorator adding a fix for all codes containing key'''
+    assert stage in stages
+    def add(func):
+        registry.setdefault(key, []).append((stage, func))
+        return func
+    return add
+
+def matching(codes, stage):
+    '''(code, fix) pairs for stage, in the order of codes'''
+    return [(code, func) for code in codes for key, funcs in registry.items() if key in code
+                         for fix_stage, func in funcs if fix_stage == stage]
+
+def fix_files(codes, gfiles):
+    '''apply the 'files' fixes of codes, returns gfiles'''
+    for code, func in matching(codes, 'files'):
+        gfiles = func(code, gfiles)
+    return gfiles
+
+def preprocessor(codes, base):
+    '''open_mfdataset preprocess function: base followed by the 'preprocess' fixes of codes'''
+    funcs = [func for code, func in matching(codes, 'preprocess')]
+    def preprocess(ds):
+        ds = base(ds)
+        for func in funcs:
+            ds = func(ds)
+        return ds
+    return preprocess
+
+def fix_dataset(codes, ds, gfiles, svar):
+    '''apply the 'dataset' fixes of codes to the concatenated dataset'''
+    for code, func in matching(codes, 'dataset'):
+        ds = func(code, ds, gfiles, svar)
+    return ds
+
+def _first_year(gfiles):
+    return gfiles[0].split('-')[-2][-6:-2]
+
+# ---- the fixes ----
+
+@register('deptht', 'preprocess')
+def rename_deptht(ds):
+    # NEMO depth axis: deptht -> olevel, renamed as the files are opened - renaming a coordinate
+    # dimension in place (ncrename or netCDF4) loses its values with some netcdf-c/hdf5 versions
+    names = {'deptht': 'olevel', 'deptht_bounds': 'olevel_bounds'}
+    return ds.rename({old: new for old, new in names.items() if old in ds.variables or old in ds.dims})
+
+@register('remove_files', 'files')
+def remove_duplicate_files(code, gfiles):
+    # NorESM2-LM has both ...1230.nc and ...1231.nc versions of some files
+    for gfile in gfiles:
+        if gfile.endswith('1230.nc') and 'NorESM2-LM' in gfile:
+            os.remove(gfile)
+    return [gfile for gfile in gfiles if '1231.nc' in gfile]
+
+@register('fix_time', 'preprocess')
+def monthly_gregorian(ds):
+    start = str(ds.time.values[0])[:4]
+    ds['time'] = xr.cftime_range(start=start, periods=ds.time.shape[0], freq='MS', calendar='gregorian').shift(15,'D')
+    return ds
+
+@register('drop_height', 'preprocess')
+def drop_height(ds):
+    if 'height' in ds.coords:
+        ds = ds.drop('height')
+    return ds
+
+@register('drop_tb', 'dataset')
+def drop_time_bounds(code, ds, gfiles, svar):
+    # to_zarr cannot do chunking with time_bounds/time_bnds which is cftime (an object, not float)
+    timeb = [var for var in ds.coords if 'time_bnds' in var or 'time_bounds' in var][0]
+    return ds.drop(timeb)
+
+@register('time_', 'dataset')
+def select_years(code, ds, gfiles, svar):
+    [y1,y2] = code.split('_')[-1].split('-')
+    return ds.sel(time=slice(str(y1)+'-01-01',str(y2)+'-12-31'))
+
+@register('360_day', 'dataset')
+def monthly_360_day(code, ds, gfiles, svar):
+    year = _first_year(gfiles)
+    ds['time'] = cftime.num2date(np.arange(ds.time.shape[0]), units='months since '+year+'-01-16', calendar='360_day')
+    return ds
+
+@register('noleap', 'dataset')
+def monthly_noleap(code, ds, gfiles, svar):
+    year = _first_year(gfiles)
+    ds['time'] = xr.cftime_range(start=year, periods=ds.time.shape[0], freq='MS', calendar='noleap').shift(15, 'D')
+    return ds
+
+@register('missing', 'dataset')
+def drop_missing_value(code, ds, gfiles, svar):
+    del ds[svar].encoding['missing_value']
+    return ds
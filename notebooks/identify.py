@@ -1,15 +1,58 @@
-import warnings
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import requests
 import zarr
 import fsspec
 
-def get_version(zstore,method='fsspec'):
+from fileio import JsonCache
 
-    client = requests.session()
-    baseurl =  'http://hdl.handle.net/api/handles/'
-    query1 = '?type=IS_PART_OF'
-    query2 = '?type=VERSION_NUMBER'
+handle_url = 'http://hdl.handle.net/api/handles/'
+
+class HandleCache(JsonCache):
+    '''values of hdl.handle.net handles (IS_PART_OF, VERSION_NUMBER) by type and handle'''
+    # The VERSION_NUMBER of a dataset handle never changes, so it is never asked for again.
+    # The IS_PART_OF of a file handle gains a parent whenever a newer dataset version reuses
+    # the file, so it is only kept for ttl[type] seconds (0: not cached at all).
+
+    def __init__(self, file='cache/handles.json', ttl={'IS_PART_OF': 24*3600}):
+        super().__init__(file)
+        self.ttl = ttl
+
+    def get(self, handle, type):
+        value = self.values.get(type, {}).get(handle)
+        if type in self.ttl:
+            # [value, time fetched]
+            if not isinstance(value, list) or time.time() - value[1] >= self.ttl[type]:
+                return None
+            return value[0]
+        return value
+
+    def put(self, handle, type, value):
+        if type in self.ttl:
+            if self.ttl[type] <= 0:
+                return
+            value = [value, time.time()]
+        with self._lock:
+            self.values.setdefault(type, {})[handle] = value
+
+def _handle_value(client, handle, type, cache):
+    value = cache.get(handle, type)
+    if value is None:
+        r = client.get(handle_url + handle + '?type=' + type, timeout=(10, 60))
+        r.raise_for_status()
+        value = r.json()['values'][0]['data']['value']
+        cache.put(handle, type, value)
+    return value
+
+def get_version(zstore,method='fsspec',cache=None,client=None):
+    # cache - HandleCache (None: the one in cache/handles.json, saved when done)
+    save = cache is None
+    if cache is None:
+        cache = HandleCache()
+    if client is None:
+        client = requests.session()
 
     # get the `netcdf_tracking_ids` from the zstore metadata
     if method == 'fsspec':
@@ -23,246 +66,210 @@ def get_version(zstore,method='fsspec'):
     versions = []
     datasets = []
     for file_tracking_id in tracking_ids.split('\n')[0:1]:
-        url = baseurl+file_tracking_id[4:]+query1
-        r = client.get(url)
-        r.raise_for_status()
-        dataset_tracking_id = r.json()['values'][0]['data']['value']
+        dataset_tracking_id = _handle_value(client, file_tracking_id[4:], 'IS_PART_OF', cache)
         datasets += [dataset_tracking_id]
         if ';' in dataset_tracking_id:
             # multiple dataset_ids erroneously reported
             dtracks = dataset_tracking_id.split(';')
             vs = []
             for dtrack in dtracks:
-                url2 = baseurl + dtrack[4:] + query2
-                r = client.get(url2)
-                r.raise_for_status()
-                r.json()['values'][0]['data']['value']
-                vs += [r.json()['values'][0]['data']['value']]
+                vs += [_handle_value(client, dtrack[4:], 'VERSION_NUMBER', cache)]
             v = sorted(vs)[-1]    
         else:
-            url2 = baseurl + dataset_tracking_id[4:] + query2
-            r = client.get(url2)
-            r.raise_for_status()
-            v = r.json()['values'][0]['data']['value']
+            v = _handle_value(client, dataset_tracking_id[4:], 'VERSION_NUMBER', cache)
         versions += [v]
 
     version_id = list(set(versions))
     dataset_id = list(set(datasets))
 
     assert len(version_id)==1
-    
+
+    if save:
+        cache.save()
     return dataset_id[0], version_id[0]
 
+def get_versions(zstores, method='fsspec', max_workers=16, cache=None, verbose=False):
+    '''get_version of many zstores at once - DataFrame of zstore, dataset_id, version and error'''
+    # Only handles missing from the cache (cache/handles.json by default) go to hdl.handle.net.
+    if cache is None:
+        cache = HandleCache()
+    client = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    client.mount('http://', adapter)
+    client.mount('https://', adapter)
+
+    def resolve(zstore):
+        try:
+            dataset_id, version = get_version(zstore, method=method, cache=cache, client=client)
+            return dict(zstore=zstore, dataset_id=dataset_id, version=version, error='')
+        except Exception as e:
+            if verbose:
+                print('no version for', zstore, repr(e))
+            return dict(zstore=zstore, dataset_id=None, version=None, error=repr(e))
+
+    zstores = list(dict.fromkeys(zstores))
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(resolve, zstores))
+    finally:
+        cache.save()
+    return pd.DataFrame(results, columns=['zstore','dataset_id','version','error'])
+
+zarr_keys = ['activity_drs','institution_id','source_id','experiment_id','member_id','table_id','variable_id','grid_label']
+_store_keys = ['experiment_id','source_id','member_id','grid_label']
+
+def _requested(df_req, dESGF, member_rule):
+    '''rows of dESGF asked for in df_req, with the zarr_file of their store, in request order'''
+    # member_rule(member_ids) -> ('all'|'one'|'list', members, list_order)
+    # Each store (request expansion, experiment, source, member, grid) is numbered by _store.
+    # The rows come in the order of the nested request/variable/experiment/source/member/grid
+    # loops used before: a request list in its own order, 'All' in order of first appearance.
+    de = dESGF.reset_index(drop=True)
+    de['_row'] = np.arange(len(de))
+    group = ['table_id','variable_id']
+    for key in _store_keys:
+        group += [key]
+        de['_first_'+key] = de.groupby(group, sort=False, observed=True)._row.transform('min')
+
+    # one row per request, variable, experiment and source (None - 'All')
+    queries = []
+    for req, (index, row) in enumerate(df_req.iterrows()):
+        experiments = [None] if row['experiments'] == ['All'] else row['experiments']
+        sources = [None] if row['models'] == ['All'] else row['models']
+        for nvar, variable_id in enumerate(row['variables']):
+            for nexp, experiment_id in enumerate(experiments):
+                for nsrc, source_id in enumerate(sources):
+                    queries += [dict(_req=req, _var=nvar, _exp=nexp, _src=nsrc, table_id=row['table'],
+                                     variable_id=variable_id, experiment_id=experiment_id,
+                                     source_id=source_id, _members=member_rule(row['members']))]
+    if len(queries) == 0:
+        return None
+    dq = pd.DataFrame(queries)
+    dq['_q'] = np.arange(len(dq))
+
+    # join on the facets given (hash joins - one for each combination of 'All')
+    dkeys = de[['table_id','variable_id','experiment_id','source_id']].astype(object)
+    dkeys['_row'] = de._row
+    matches = []
+    for (any_exp, any_src), dqs in dq.groupby([dq.experiment_id.isna(), dq.source_id.isna()]):
+        on = ['table_id','variable_id'] + ([] if any_exp else ['experiment_id']) + ([] if any_src else ['source_id'])
+        matches += [dqs[on + ['_q']].merge(dkeys[on + ['_row']], on=on)[['_q','_row']]]
+    dm = pd.concat(matches)
+    if len(dm) == 0:
+        return None
+    df = de.iloc[dm._row.values].reset_index(drop=True)
+    df = df.join(dq.drop(columns=['table_id','variable_id','experiment_id','source_id'])
+                   .iloc[dm._q.values].reset_index(drop=True))
+    df.loc[dq.experiment_id.isna().values[df._q], '_exp'] = df._first_experiment_id
+    df.loc[dq.source_id.isna().values[df._q], '_src'] = df._first_source_id
+
+    # members of each query and source
+    mem = df._first_member_id.values.copy()
+    keep = np.ones(len(df), dtype=bool)
+    member_id = df.member_id.astype(object).values
+    for q, rows in df.groupby('_q').indices.items():
+        mode, members, list_order = dq._members[q]
+        if mode == 'one':
+            first = df.iloc[rows].groupby(['experiment_id','source_id'], observed=True)._first_member_id.transform('min')
+            keep[rows] = mem[rows] == first.values
+        elif mode == 'list':
+            keep[rows] = np.isin(member_id[rows], members)
+            if list_order:
+                position = {member: n for n, member in reversed(list(enumerate(members)))}
+                mem[rows] = [position.get(member, -1) for member in member_id[rows]]
+    df['_mem'] = mem
+    df = df[keep]
+
+    order = ['_req','_var','_exp','_src','_mem','_first_grid_label','_row']
+    df = df.sort_values(order, kind='stable')
+    df['_store'] = df.groupby(['_q'] + _store_keys, sort=False, observed=True).ngroup()
+
+    # the store takes its name from the first row of its files
+    first = df.groupby('_store')[zarr_keys].transform('first').astype(str)
+    df['_zarr_file'] = '/' + first[zarr_keys[0]].str.cat([first[key] for key in zarr_keys[1:]], sep='/') + '/'
+    df.index = dESGF.index[df._row.values]
+    return df
+
+def _result(df, dESGF, select=None):
+    '''the rows of dESGF in df (optionally only those in select) with their zstore column'''
+    if select is not None:
+        df = df[select]
+    if df is None or len(df) == 0:
+        #print('no new data available')
+        return dESGF[dESGF.source_id=='junk']
+    dr = df[list(dESGF.columns)].copy()
+    dr['zstore'] = df._zarr_file.values
+    return dr
+
+def _needed_members(member_ids):
+    if len(member_ids[0]) == 0:
+        member_ids = ['All']
+    if len(member_ids) == 1:
+        return ('one', None, False) if member_ids[0] == 'One' else ('all', None, False)
+    return ('list', member_ids, True)
+
 def needed(dfm, df_req, dESGF):
     # Makes list of available zstores which are NOT in cloud 
     # dfm - df of data in cloud
     # df_req - request
     # dESGF - df of data available at ESGF matching request
+    df = _requested(df_req, dESGF, _needed_members)
+    if df is None:
+        return _result(df, dESGF)
 
-    ngood = 0
-    zarr_format = '/%(activity_drs)s/%(institution_id)s/%(source_id)s/%(experiment_id)s/\
-%(member_id)s/%(table_id)s/%(variable_id)s/%(grid_label)s/'
-    df_list = []
-
-    for index, row in df_req.iterrows():
-
-        timestamp = row['Timestamp']
-        name = row['requester']
-        email = row['E-mail']
-        experiment_ids = row['experiments']
-        source_ids = row['models']
-        variable_ids = row['variables']
-        member_ids = row['members']
-        table_id = row['table']
-
-        if len(member_ids[0]) == 0:
-            member_ids = ['All']
-            
-        for variable_id in variable_ids:
-            if experiment_ids == ['All']:
-                experiments = dESGF[(dESGF.table_id==table_id)&(dESGF.variable_id==variable_id)].experiment_id.unique()
-            else:
-                experiments = experiment_ids
-
-            for experiment_id in experiments:
-                if source_ids == ['All']:
-                    sources = dESGF[(dESGF.experiment_id==experiment_id)&(dESGF.table_id==table_id)&
-                               (dESGF.variable_id==variable_id)].source_id.unique()
-                    #print(variable_id,experiment_id,sources)
-                else:
-                    sources = source_ids
-                for source_id in sources:
-                    df = dESGF[(dESGF.experiment_id==experiment_id)&(dESGF.table_id==table_id)&
-                            (dESGF.variable_id==variable_id)    &(dESGF.source_id==source_id)]
-                    if len(df) == 0:
-                        continue
-
-                    members = df.member_id.unique()
-           
-                    if len(member_ids) == 1 :
-                        first = member_ids[0]
-                        if first == 'One':
-                            members = [members[0]]
-                    elif first != 'All':
-                        if len(first) <=3 :
-                                members = members[:int(member_ids[0])]
-                        else:
-                             members = [first]
-                    elif len(member_ids) >= 2 :
-                        members = member_ids
-                       
-                    for member_id in members:
-                        
-                        df_member = df[df.member_id==member_id]
-                           
-                        grid_labels = df_member.grid_label.unique()  
-                        
-                        for grid_label in grid_labels:
-                            df_grid = df_member[df_member.grid_label==grid_label]
-                            try:
-                                file = df_grid.values[0]
-                            except:
-                                continue
- 
-                            #print(experiment_id,variable_id,source_id,member_id,grid_label)
-                            
-                            zarr_dir = dict(zip(df.keys(),file))
-                            zarr_file = zarr_format % zarr_dir 
-
-                            zstore = 'gs://cmip6' + zarr_file 
-                        
-                            #print(zstore)
-                            df_cloud = dfm[(dfm.zstore==zstore)]
-                            
-                            if len(df_cloud) >= 1:
-                                #print('store already in cloud')
-                                continue
-                            else:
-                                ngood += 1
-
-                            with warnings.catch_warnings():
-                                warnings.filterwarnings("ignore")
-                                df_grid.loc[:,'zstore'] = zarr_file
-
-                            df_list += [df_grid]
-
-    if ngood >= 1:
-        return pd.concat(df_list)
-    else: 
-        #print('no new data available')
-        return dESGF[dESGF.source_id=='junk']
+    # anti-join with the cloud catalog
+    in_cloud = ('gs://cmip6' + df._zarr_file).isin(set(dfm.zstore))
+    return _result(df, dESGF, ~in_cloud.values)
+
+def _newversion_members(member_ids):
+    if len(member_ids) == 1 and member_ids[0] == 'One':
+        return ('one', None, False)
+    if len(member_ids) == 1 and member_ids[0] == 'All':
+        return ('all', None, False)
+    return ('list', member_ids, False)
 
 def needed_newversion(dfm, df_req, dESGF):
     # Makes list of available zstores which are not in cloud OR have new versions available
     # dfm - df of data in cloud (version known)
     # df_req - request
     # dESGF - df of data available at ESGF matching request
+    df = _requested(df_req, dESGF, _newversion_members)
+    if df is None:
+        return _result(df, dESGF)
 
-    newv = 0
-    zarr_format = '/%(activity_drs)s/%(institution_id)s/%(source_id)s/%(experiment_id)s/\
-%(member_id)s/%(table_id)s/%(variable_id)s/%(grid_label)s/'
-    df_list = []
-
-    for index, row in df_req.iterrows():
-
-        timestamp = row['Timestamp']
-        name = row['requester']
-        email = row['E-mail']
-        experiment_ids = row['experiments']
-        source_ids = row['models']
-        variable_ids = row['variables']
-        member_ids = row['members']
-        table_id = row['table']
-
-        #if len(member_ids[0]) == 0:
-        #    member_ids = ['All']
-            
-        for variable_id in variable_ids:
-            if experiment_ids == ['All']:
-                experiments = dESGF[(dESGF.table_id==table_id)&(dESGF.variable_id==variable_id)].experiment_id.unique()
-            else:
-                experiments = experiment_ids
-
-            for experiment_id in experiments:
-                if source_ids == ['All']:
-                    sources = dESGF[(dESGF.experiment_id==experiment_id)&(dESGF.table_id==table_id)&
-                               (dESGF.variable_id==variable_id)].source_id.unique()
-                    #print(variable_id,experiment_id,sources)
-                else:
-                    sources = source_ids
-                for source_id in sources:
-                    df = dESGF[(dESGF.experiment_id==experiment_id)&(dESGF.table_id==table_id)&
-                            (dESGF.variable_id==variable_id)    &(dESGF.source_id==source_id)]
-                    if len(df) == 0:
-                        continue
-
-                    source_members = df.member_id.unique()
-              
-                    members = list(set(member_ids)&set(source_members))
-                    
-                    if len(member_ids) == 1 :
-                        first = member_ids[0]
-                        if first == 'One':
-                            members = [source_members[0]]
-                        elif first == 'All':
-                            members = source_members
-
-                    for member_id in members:
-                        df_member = df[df.member_id==member_id]
-                           
-                        grid_labels = df_member.grid_label.unique()  
-                        
-                        for grid_label in grid_labels:
-                            df_grid = df_member[df_member.grid_label==grid_label]
-                            try:
-                                file = df_grid.values[0]
-                            except:
-                                continue
- 
-                            #print(experiment_id,variable_id,source_id,member_id,grid_label)
-    
-                            zarr_dir = dict(zip(df.keys(),file))
-                            zarr_file = zarr_format % zarr_dir 
-                            zstore = 'gs://cmip6' + zarr_file 
-                
-                            eversions = df_grid.version.unique()
-                            #print(df_grid.values)
-                            if len(eversions) > 1:
-                                version1 = sorted(eversions)[-1][1:]
-                                print('picking last version due to multiple esgf API version bug:',eversions,version1)
-                                #continue
-                            else:
-                                version1 = df_grid.version.values[0][1:]
-                            df_grid = df_grid[df_grid.version=='v'+version1]
-
-                            df_cloud = dfm[dfm.zstore==zstore]
-                            if len(df_cloud) >= 1:
-                                cversions = df_cloud.version.unique()
-                                if len(cversions) > 1:
-                                    version2 = sorted(cversions)[-1]
-                                    print('skipping due to multiple cloud versions:',zstore,cversions,version2)
-                                    continue
-                                else:
-                                    version2 = df_cloud.version.values[0]
-
-                                if int(version1) == int(version2):  
-                                    #print('same version already in cloud')
-                                    continue
-                                else:
-                                    print('new version available',zstore,'new: ',version1,'old: ',version2)
-                                    newv += 1
-                            else:
-                                #print('zstore not in cloud yet')
-                                continue
-
-                            with warnings.catch_warnings():
-                                warnings.filterwarnings("ignore")
-                                df_grid.loc[:,'zstore'] = zarr_file
-
-                            df_list += [df_grid]
-
-    if newv >= 1:
-        return pd.concat(df_list)
-    else: 
-        #print('no new data available')
-        return dESGF[dESGF.source_id=='junk']
+    # latest ESGF version of each store
+    version = df.version.astype(str)
+    versions = np.sort(version.unique())
+    vcode = pd.Series(np.searchsorted(versions, version.values), index=df.index)
+    latest = pd.Series(versions[vcode.groupby(df._store.values).transform('max').values], index=df.index)
+    nversions = vcode.groupby(df._store.values).transform('nunique')
+
+    # versions in the cloud catalog of each store
+    cloud = dfm.groupby('zstore').version.unique()
+
+    several = (nversions > 1).values
+    eversions = version[several].groupby(df._store.values[several], sort=False).unique()
+
+    new = set()
+    stores = df[['_store','_zarr_file']].assign(latest=latest.values, nversions=nversions.values)
+    for store, zarr_file, version1, nv in stores.drop_duplicates('_store').values:
+        version1 = version1[1:]
+        if nv > 1:
+            print('picking last version due to multiple esgf API version bug:',eversions[store],version1)
+        zstore = 'gs://cmip6' + zarr_file
+        if zstore not in cloud.index:
+            #print('zstore not in cloud yet')
+            continue
+        cversions = cloud[zstore]
+        if len(cversions) > 1:
+            version2 = sorted(cversions)[-1]
+            print('skipping due to multiple cloud versions:',zstore,cversions,version2)
+            continue
+        version2 = cversions[0]
+        if int(version1) == int(version2):
+            #print('same version already in cloud')
+            continue
+        print('new version available',zstore,'new: ',version1,'old: ',version2)
+        new.add(store)
+
+    return _result(df, dESGF, (df._store.isin(new) & (version == latest)).values)
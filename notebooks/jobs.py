@@ -0,0 +1,85 @@
+"""Crash-safe record of how far each zarr store has got
+
+   A small sqlite database with the last stage reached by every store, so an interrupted
+   request can be resumed without listing the bucket again, and the time spent in each stage.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+import pandas as pd
+
+# in order - a store which reached a stage has passed all the earlier ones
+stages = ['downloaded', 'concatenated', 'written', 'uploaded', 'verified', 'cataloged']
+
+class JobStore:
+    '''last stage reached by each store, plus a log of stage timings'''
+
+    def __init__(self, db='txt/jobs.sqlite'):
+        self.db = db
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(db, check_same_thread=False)
+        with self._lock:
+            self.con.execute('pragma journal_mode=wal')
+            self.con.execute('''create table if not exists jobs (
+                                    zstore text primary key, stage text, status text,
+                                    message text, details text, updated real)''')
+            self.con.execute('''create table if not exists timings (
+                                    zstore text, stage text, started real, finished real)''')
+
+    def close(self):
+        self.con.close()
+
+    def stage(self, zstore):
+        '''last stage reached by zstore (None if never started)'''
+        with self._lock:
+            row = self.con.execute('select stage from jobs where zstore=?', (zstore,)).fetchone()
+        return None if row is None or row[0] is None else row[0]
+
+    def done(self, zstore, stage):
+        '''has zstore reached (or passed) stage?'''
+        reached = self.stage(zstore)
+        return reached is not None and stages.index(reached) >= stages.index(stage)
+
+    def details(self, zstore):
+        '''whatever was saved with the last stage (e.g. the catalog row of a written store)'''
+        with self._lock:
+            row = self.con.execute('select details from jobs where zstore=?', (zstore,)).fetchone()
+        return None if row is None or row[0] is None else json.loads(row[0])
+
+    def record(self, zstore, stage, started=None, details=None, message=''):
+        '''zstore has reached stage (started - when the stage started, for the timings)'''
+        assert stage in stages
+        now = time.time()
+        with self._lock, self.con:
+            self.con.execute('''insert into jobs (zstore, stage, status, message, details, updated)
+                                values (?, ?, 'ok', ?, ?, ?)
+                                on conflict(zstore) do update set stage=excluded.stage, status='ok',
+                                    message=excluded.message, updated=excluded.updated,
+                                    details=coalesce(excluded.details, jobs.details)''',
+                             (zstore, stage, message, None if details is None else json.dumps(details), now))
+            if started is not None:
+                self.con.execute('insert into timings values (?, ?, ?, ?)', (zstore, stage, started, now))
+
+    def fail(self, zstore, stage, message=''):
+        '''stage failed for zstore - the last stage reached is kept'''
+        with self._lock, self.con:
+            self.con.execute('''insert into jobs (zstore, stage, status, message, updated)
+                                values (?, null, 'failed', ?, ?)
+                                on conflict(zstore) do update set status='failed',
+                                    message=excluded.message, updated=excluded.updated''',
+                             (zstore, f'{stage}: {message}', time.time()))
+
+    def status(self):
+        '''DataFrame of all stores: stage, status, message and time of last update'''
+        with self._lock:
+            return pd.read_sql_query('select zstore, stage, status, message, updated from jobs', self.con)
+
+    def stats(self):
+        '''number of stores, total and mean seconds, and stores per hour for each stage'''
+        with self._lock:
+            dt = pd.read_sql_query('select stage, finished - started as seconds from timings', self.con)
+        ds = dt.groupby('stage').seconds.agg(['count', 'sum', 'mean'])
+        ds['per_hour'] = 3600 / ds['mean']
+        return ds.reindex([s for s in stages if s in ds.index])
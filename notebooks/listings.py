@@ -0,0 +1,205 @@
+"""The ncsv/ listings as partitioned parquet datasets
+
+   The GC_files_<activity_id>-<institution_id>.csv listings of the bucket and the
+   cmip6-<activity_id>-<institution_id>.csv catalog slices are kept as one parquet file
+   per activity_id/institution_id (ncsv/GC_files/activity_id=.../institution_id=.../part.parquet),
+   with the facets dictionary encoded. The whole listing is read (memory mapped) in one go,
+   and an update or removal only rewrites the partitions it touches.
+   to_csv() writes the old csv files.
+   Each old csv listing is migrated once (recorded in _migrated.json): a removal from a
+   partition not migrated yet migrates it first, so a removed store can't come back from its csv.
+
+   usage: gc_files = Listings('GC_files'); gc_files.migrate(glob('ncsv/GC_files_*.csv'))
+"""
+
+import os
+import json
+import shutil
+from glob import glob
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fileio import write_atomic, write_json
+
+facet_keys = ['activity_id','institution_id','source_id','experiment_id','member_id','table_id','variable_id','grid_label']
+
+partition_keys = ['activity_id', 'institution_id']
+
+def zstore_facets(zstores):
+    '''DataFrame of the 8 facets of the zstores gs://cmip6/activity_id/.../grid_label/'''
+    parts = pd.Series(zstores, dtype=object).str.split('/', expand=True)
+    if len(parts) == 0:
+        return pd.DataFrame(columns=facet_keys, dtype=object)
+    return pd.DataFrame({key: parts[n+3].values for n, key in enumerate(facet_keys)})
+
+class Listings:
+    '''a partitioned listing (kind 'GC_files' or 'cmip6') under root'''
+    # GC_files listings have a zstore column (gs://cmip6/.../grid_label/, without .zmetadata),
+    # catalog slices the columns of their csv files; all other columns are kept as str.
+
+    def __init__(self, kind='GC_files', root='ncsv'):
+        self.kind = kind
+        self.root = root
+        self.path = f'{root}/{kind}'
+
+    def partition_dir(self, activity_id, institution_id):
+        return f'{self.path}/activity_id={activity_id}/institution_id={institution_id}'
+
+    def partitions(self):
+        '''(activity_id, institution_id) of all partitions'''
+        dirs = glob(f'{self.path}/activity_id=*/institution_id=*')
+        return sorted(tuple(d.split('=')[-1] for d in os.path.relpath(d, self.path).split('/')) for d in dirs)
+
+    def read(self, columns=None, **facets):
+        '''the listing as a DataFrame (facets as categoricals), only the rows matching facets
+
+           facets - a value or a list of values for any column, e.g. activity_id='CMIP'
+        '''
+        if len(self.partitions()) == 0:
+            return pd.DataFrame(columns=(['zstore'] + facet_keys) if columns is None else columns)
+        filters = [(key, 'in', [values] if isinstance(values, str) else list(values))
+                   for key, values in facets.items()]
+        table = pq.read_table(self.path, columns=columns, filters=filters or None,
+                              partitioning='hive', memory_map=True)
+        df = table.to_pandas()
+        cols = [col for col in self._order(table.schema.names) if columns is None or col in columns]
+        return df[cols]
+
+    def _order(self, names):
+        # the csv column order: partition columns come last from parquet
+        names = list(names)
+        if self.kind == 'GC_files':
+            return ['zstore'] + [key for key in facet_keys if key in names] + \
+                   [name for name in names if name not in facet_keys and name != 'zstore']
+        order = [name for name in self._csv_columns() if name in names]
+        return order + [name for name in names if name not in order]
+
+    def _csv_columns(self):
+        meta = pq.read_schema(glob(f'{self.path}/*/*/part.parquet')[0]).metadata or {}
+        return meta.get(b'csv_columns', b'').decode().split(',')
+
+    def write(self, df, partitions=()):
+        '''replace the partitions of the activity_id/institution_id in df by the rows of df
+
+           partitions - (activity_id, institution_id) also replaced: those without rows in df are removed
+        '''
+        df = df.copy()
+        if self.kind == 'GC_files':
+            df = df[['zstore']].reset_index(drop=True)
+            df = pd.concat([df, zstore_facets(df.zstore.values)], axis=1)
+        csv_columns = [col for col in df.columns]
+        for key in df.columns:
+            if key in facet_keys:
+                df[key] = df[key].astype(str).astype('category')
+            else:
+                df[key] = df[key].where(df[key].isna(), df[key].astype(str))
+        for (activity_id, institution_id), dp in df.groupby(partition_keys, sort=False, observed=True):
+            dp = dp.drop(columns=partition_keys)
+            for key in dp.columns:
+                if key in facet_keys:
+                    dp[key] = dp[key].cat.remove_unused_categories()
+            schema = pa.schema([(key, pa.dictionary(pa.int32(), pa.string()) if key in facet_keys else pa.string())
+                                for key in dp.columns])
+            table = pa.Table.from_pandas(dp, schema=schema, preserve_index=False)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   b'csv_columns': ','.join(csv_columns).encode()})
+            pdir = self.partition_dir(activity_id, institution_id)
+            os.makedirs(pdir, exist_ok=True)
+            write_atomic(pdir + '/part.parquet', lambda tmp: pq.write_table(table, tmp))
+
+        written = set(map(tuple, df[partition_keys].astype(str).drop_duplicates().values))
+        for activity_id, institution_id in set(partitions) - written:
+            pdir = self.partition_dir(activity_id, institution_id)
+            if os.path.isdir(pdir):
+                shutil.rmtree(pdir)
+
+    def update(self, df):
+        '''add the rows of df, replacing the rows with the same zstore'''
+        dz = zstore_facets(df.zstore.values)[partition_keys].drop_duplicates()
+        old = [self.read(activity_id=activity_id, institution_id=institution_id)
+               for activity_id, institution_id in dz.values]
+        old = pd.concat(old, ignore_index=True).astype(object)
+        keep = ~old.zstore.isin(df.zstore)
+        self.write(pd.concat([old[keep], df.astype(object)], ignore_index=True))
+
+    def remove(self, zstores):
+        '''remove the rows of zstores, rewriting only the partitions they are in
+
+           returns the number of rows removed
+        '''
+        zstores = pd.unique(pd.Series(list(zstores), dtype=object))
+        dz = zstore_facets(zstores)
+        removed = 0
+        for (activity_id, institution_id), dp in dz.groupby(partition_keys, sort=False):
+            self.migrate([self.csv_file(activity_id, institution_id)])
+            pdir = self.partition_dir(activity_id, institution_id)
+            if not os.path.isfile(pdir + '/part.parquet'):
+                continue
+            old = self.read(activity_id=activity_id, institution_id=institution_id)
+            drop = old.zstore.isin(zstores[dp.index.values])
+            if drop.any():
+                removed += int(drop.sum())
+                if drop.all():
+                    shutil.rmtree(pdir)
+                else:
+                    self.write(old[~drop].astype(object))
+        return removed
+
+    def import_csv(self, files):
+        '''replace the partitions of the old csv listings (<kind>_<activity_id>-<institution_id>.csv)
+           by their contents - an empty listing removes its partition'''
+        partitions = [self.csv_partition(file) for file in files]
+        partitions = [p for p in partitions if p is not None]
+        files = [file for file in files if os.path.getsize(file) > 0]
+        if self.kind == 'GC_files':
+            df = pd.concat([pd.DataFrame(columns=['zstore'], dtype=object)] +
+                           [pd.read_csv(file, names=['zstore'], dtype='unicode') for file in files],
+                           ignore_index=True)
+            df['zstore'] = df.zstore.str.replace('.zmetadata', '', regex=False)
+        else:
+            # kept as written ('NA' and empty stay strings)
+            dfs = [pd.read_csv(file, dtype='unicode', keep_default_na=False) for file in files]
+            df = pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else \
+                 pd.DataFrame(columns=['zstore'] + partition_keys, dtype=object)
+        self.write(df.drop_duplicates('zstore'), partitions=partitions)
+        self._set_migrated(self._migrated() | set(partitions))
+
+    def migrate(self, files):
+        '''import_csv the old csv listings whose partitions were never imported (existing files only)'''
+        migrated = self._migrated()
+        files = [file for file in files if os.path.isfile(file) and self.csv_partition(file) not in migrated]
+        if len(files) > 0:
+            self.import_csv(files)
+
+    def _migrated(self):
+        # partitions already imported from their csv; before _migrated.json, all existing partitions
+        file = f'{self.path}/_migrated.json'
+        if not os.path.isfile(file):
+            return set(self.partitions())
+        with open(file) as f:
+            return set(map(tuple, json.load(f)))
+
+    def _set_migrated(self, partitions):
+        os.makedirs(self.path, exist_ok=True)
+        write_json(f'{self.path}/_migrated.json', sorted(partitions))
+
+    def csv_file(self, activity_id, institution_id):
+        '''the old csv listing of a partition'''
+        return f'{self.root}/{self.kind}_{activity_id}-{institution_id}.csv'
+
+    def csv_partition(self, file):
+        '''(activity_id, institution_id) of an old csv listing, None if not in the name'''
+        name = os.path.basename(file)[:-len('.csv')]
+        parts = name[len(self.kind)+1:].split('-', 1)
+        if not name.startswith(self.kind) or len(parts) < 2 or '' in parts:
+            return None
+        return tuple(parts)
+
+    def to_csv(self, file, **facets):
+        '''write (part of) the listing in the old csv layout'''
+        df = self.read(**facets)
+        if self.kind == 'GC_files':
+            write_atomic(file, lambda tmp: (df.zstore.astype(str) + '.zmetadata').to_csv(tmp, header=False, index=False))
+        else:
+            write_atomic(file, lambda tmp: df.to_csv(tmp, index=False))
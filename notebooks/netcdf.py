@@ -2,34 +2,172 @@ import os
 import numpy as np
 import pandas as pd
 import xarray as xr
+import zarr
 import datetime
-import time
 import cftime
+import netCDF4
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks
 
 def set_bnds_as_coords(ds):
     new_coords_vars = [var for var in ds.data_vars if 'bnds' in var or 'bounds' in var]
     ds = ds.set_coords(new_coords_vars)
     return ds
 
-def set_bnds_as_coords_drop_height(ds):
-    ds = set_bnds_as_coords(ds)
-    if 'height' in ds.coords:
-        ds = ds.drop('height')
-    return ds
+# time steps per year for each table frequency (first one found in table_id wins)
+steps_per_year = [('subhr', 365*48), ('3hr', 365*8), ('6hr', 365*4), ('hr', 365*24),
+                  ('day', 365), ('mon', 12), ('clim', 12), ('yr', 1), ('dec', 0.1), ('fx', None)]
 
-def convert2gregorian(ds):
-    ds = set_bnds_as_coords(ds)
-    start = str(ds.time.values[0])[:4]
-    ds['time'] = xr.cftime_range(start=start, periods=ds.time.shape[0], freq='MS', calendar='gregorian').shift(15,'D')
-    return ds
+def table_steps(table_id):
+    '''time steps per year of table_id (None for fixed fields)'''
+    for freq, steps in steps_per_year:
+        if freq in table_id:
+            return steps
+    return 12
+
+def plan_chunks(gfiles, table_id, svar=None, target_mb=100, nt=None):
+    '''zarr chunks for the concatenation of gfiles, about target_mb (uncompressed) each'''
+    # Uses the shape and dtype of the variable and the total number of time steps of all files
+    # (nt - if already known, e.g. from scan_headers).
+    # Time chunks are whole days/months/years where possible; a single time step larger
+    # than target_mb is split along its largest other dimension as well.
+    ds = xr.open_dataset(gfiles[0], decode_times=False)
+    if svar is None:
+        svar = ds.variable_id
+    var = ds[svar]
+    if 'time' not in var.dims:
+        ds.close()
+        return {}
+    step_bytes = var.dtype.itemsize * var.size / var.sizes['time']
+    space = {dim: size for dim, size in var.sizes.items() if dim != 'time'}
+    ds.close()
+
+    if nt is None:
+        nt = 0
+        for gfile in gfiles:
+            with xr.open_dataset(gfile, decode_times=False) as dsf:
+                nt += dsf.sizes['time']
+
+    target = target_mb * 2**20
+    chunks = {}
+    if step_bytes > target and len(space) > 0:
+        dim = max(space, key=space.get)
+        nparts = int(np.ceil(step_bytes / target))
+        chunks[dim] = int(np.ceil(space[dim] / nparts))
+        chunk = 1
+    else:
+        chunk = max(int(target // step_bytes), 1)
+        # round down to whole years, months or days of the table frequency
+        per_year = table_steps(table_id)
+        if per_year is not None:
+            for unit in [per_year, per_year/12, per_year/365]:
+                if unit >= 1 and unit == int(unit) and chunk >= unit:
+                    chunk = int(chunk // unit * unit)
+                    break
+    chunks['time'] = min(chunk, nt)
+    return chunks
+
+# the locks xarray holds around netCDF4 calls: netcdf-c/HDF5 are not thread safe, so a header
+# read in one pipeline thread must not run alongside another thread's dask reads
+_netcdf_lock = combine_locks([NETCDFC_LOCK, HDF5_LOCK])
+
+def scan_header(gfile):
+    '''tracking_id and time coverage of a netcdf file, without reading any data'''
+    head = dict(file=gfile, tracking_id='', nt=0, calendar=None,
+                units=None, start=None, stop=None, step=None, years=[])
+    values = []
+    with _netcdf_lock:
+        nc = netCDF4.Dataset(gfile)
+        nc.set_auto_mask(False)
+        try:
+            head['tracking_id'] = getattr(nc, 'tracking_id', '')
+            if 'time' in nc.variables:
+                time = nc.variables['time']
+                values = time[:]
+                head['nt'] = len(values)
+                head['units'] = time.units
+                head['calendar'] = getattr(time, 'calendar', 'standard')
+        finally:
+            nc.close()
+    if head['units'] is not None:
+        dates = cftime.num2date(values, head['units'], calendar=head['calendar'])
+        if len(dates) > 0:
+            head['start'] = dates[0]
+            head['stop'] = dates[-1]
+            head['years'] = sorted(set(date.year for date in dates))
+        if len(dates) > 1:
+            head['step'] = np.median(np.diff(dates))
+    return head
+
+def scan_headers(gfiles, max_workers=1):
+    '''DataFrame of scan_header for each file (in order), optionally in parallel processes'''
+    # In the calling thread each header holds xarray's netCDF locks (see scan_header), so it
+    # waits for other threads' reads; max_workers > 1 uses spawned processes instead (the
+    # pipeline has threads). A header takes milliseconds, so this only pays off for many files
+    # on a slow disk.
+    if max_workers > 1 and len(gfiles) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(gfiles)),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            heads = list(pool.map(scan_header, gfiles))
+    else:
+        heads = [scan_header(gfile) for gfile in gfiles]
+    return pd.DataFrame(heads, columns=['file','tracking_id','nt','calendar','units',
+                                        'start','stop','step','years'])
+
+def years_ok(years, table_id):
+    '''no missing years in the time grid? (3hr may miss one at the end, dec has one every 10)'''
+    span = np.diff(sorted(years)).sum()
+    if '3hr' in table_id:
+        return (span == len(years)-1) | (span == len(years)-2)
+    elif 'dec' in table_id:
+        return (span/10 == len(years)) | (span/10 == len(years)-1)
+    return span == len(years)-1
+
+def check_time_grid(heads, table_id):
+    '''check the time grid of the files from scan_headers, before anything is concatenated
+
+       returns (okay, message) - not okay for mixed calendars, overlapping files or missing years;
+       gaps between files (longer than 1.5 time steps) are only reported
+    '''
+    heads = heads[heads.nt > 0]
+    if len(heads) == 0:
+        return True, ''
+    message = ''
+    okay = True
+
+    calendars = heads.calendar.unique()
+    if len(calendars) > 1:
+        return False, f'\nmixed calendars: {list(calendars)}'
+
+    for prev, head in zip(heads.itertuples(), list(heads.itertuples())[1:]):
+        if head.start <= prev.stop:
+            message += f'\ntime overlap: {os.path.basename(prev.file)} ends {prev.stop}, next starts {head.start}'
+            okay = False
+        elif prev.step is not None and head.start - prev.stop > 1.5*prev.step:
+            message += f'\ntime gap: {prev.stop} to {head.start}'
+
+    years = sorted(set(year for years in heads.years for year in years))
+    if not years_ok(years, table_id):
+        message += '\ntrouble with time grid: years ' + ','.join(str(year) for year in
+                   sorted(set(range(years[0], years[-1]+1)) - set(years)))+' missing'
+        okay = False
+    return okay, message
 
 import warnings
-def get_ncfiles(zarr,df,skip_sites,skip_string='serendipity'):
+from download import download_files, candidate_urls, NcCache
+from fixes import fix_files, preprocessor, fix_dataset
+
+def get_ncfiles(zarr,df,skip_sites,skip_string='serendipity',max_workers=8,per_host=2,stats=None,
+                cache=None):
+    # stats - download.HostStats, the record of slow/broken data nodes (skipped automatically)
+    # cache - download.NcCache of files by checksum (None uses cache/netcdf, False turns it off)
     # download any files needed for this zarr store (or abort the attempt)
     okay = True
     gfiles = []
     trouble = ''
-    check_size = True
+    verify = True
     
     files = df[df.zstore == zarr].file_name.unique()
 
@@ -46,61 +184,50 @@ def get_ncfiles(zarr,df,skip_sites,skip_string='serendipity'):
         return [], 'noUse in codes',codes, okay
     
     if 'noSizeCheck' in codes:
-        check_size = False
-
-    for file in files:
-        #print(file)
-        skip=False
-        if skip_string == 'from 1950':
-            if 'gn_18' in file:
-                skip=True
-            if 'gn_190' in file:
-                skip=True
-            if 'gn_191' in file:
-                skip=True
-            if 'gn_192' in file:
-                skip=True
-            if 'gn_193' in file:
-                skip=True
-            if 'gn_194' in file:
-                skip=True
-        if skip:
-            continue
-        if okay:
-            save_file = tmp + '/'+file
-            expected_size = df[df.file_name == file]['size'].values[0]
-            if os.path.isfile(save_file):
-                if abs(os.path.getsize(save_file) - expected_size) <= 1000 :
-                    gfiles += [save_file]
-                    continue
-
-            url = df[df.file_name == file].HTTPServer_url.values[0]
-            
+        verify = False
+
+    if skip_string == 'from 1950':
+        files = [file for file in files if not any(s in file for s in
+                 ['gn_18','gn_190','gn_191','gn_192','gn_193','gn_194'])]
+
+    df_files = df[df.file_name.isin(files)].drop_duplicates(subset='file_name')
+    df_files = df_files.set_index('file_name').loc[files].reset_index()
+
+    # drop the copies on skip_sites, giving up only if a file has no other copy
+    replica_urls = []
+    for index, row in df_files.iterrows():
+        urls = candidate_urls(row)
+        keep = [url for url in urls if not any(site in url for site in skip_sites)]
+        if len(keep) == 0:
             for site in skip_sites:
-                if site in url:
+                if site in urls[0]:
                     trouble += '\tskipping ' + site + ' domain'
-                    okay = False
-            
-            if not okay:
-                gfiles = []
-                continue
-                
-            command = 'curl ' + url + ' -o ' + save_file
-            print(command,' expected size: ',expected_size)
-            os.system(command)
-            time.sleep( 2 )  # needed when downloading many, many small files 
-
-            if check_size:
-                if os.path.getsize(save_file) != expected_size:
-                    os.system(command)
-                    actual_size = os.path.getsize(save_file)
-                    if abs(actual_size - expected_size) > 200:
-                        trouble += '\nnetcdf download not complete for: ' + url + ' expected/actual size: ' + str(expected_size) + '/' + str(actual_size)
-                        okay = False
-            if os.path.getsize(save_file) == 0:
-                os.system("rm -f "+save_file)
-            if okay:
-                gfiles += [save_file]
+            okay = False
+        replica_urls += [keep]
+    df_files['replica_urls'] = replica_urls
+    if not okay:
+        return [], trouble, codes, okay
+
+    if cache is None:
+        cache = NcCache()
+    elif cache is False:
+        cache = None
+
+    results = download_files(df_files, save_dir=tmp, max_workers=max_workers,
+                             per_host=per_host, verify=verify, stats=stats, cache=cache)
+
+    for index, result in results.iterrows():
+        if result.status == 'skipped':
+            trouble += '\tskipping slow data node ' + result.host
+            okay = False
+        elif result.status == 'failed':
+            trouble += '\nnetcdf download not complete for: ' + result.url + ' ' + result.error
+            okay = False
+        else:
+            gfiles += [result.file]
+
+    if not okay:
+        gfiles = []
                 
     return gfiles, trouble, codes, okay
 
@@ -112,113 +239,143 @@ def concatenate(zarr,gfiles,codes):
         for code in codes:
             dstr += '\ncodes = ' + code
 
-    # guess chunk size by looking a first file: (not always a good choice - e.g. cfc11)
-    nc_size = os.path.getsize(gfiles[0])
+    # fix the files (see fixes.py for the codes handled)
+    gfiles = fix_files(codes, gfiles)
+
     ds = xr.open_dataset(gfiles[0])
     svar = ds.variable_id
-    nt = ds[svar].shape[0]
 
-    chunksize_optimal = 5e7
-    chunksize = max(int(nt*chunksize_optimal/nc_size),1)
-
-    preprocess = set_bnds_as_coords
+    preprocess = preprocessor(codes, set_bnds_as_coords)
     join = 'exact'
     for code in codes:
-        if 'deptht' in code:
-            fix_string = '/usr/bin/ncrename -d .deptht\,olevel -v .deptht\,olevel -d .deptht_bounds\,olevel_bounds -v .deptht_bounds\,olevel_bounds '
-            for gfile in gfiles:
-                dstr += f'fixing deptht trouble in gfile:{gfile}'
-                os.system(f'{fix_string} {gfile}')
-        if 'remove_files' in code:
-            command = '/bin/rm nctemp/*NorESM2-LM*1230.nc'
-            os.system(command)
-            gfiles = [file for file in gfiles if ('1231.nc' in file)]
-        if 'fix_time' in code:
-            preprocess = convert2gregorian
-        if 'drop_height' in codes:
-            preprocess = set_bnds_as_coords_drop_height
         if 'override' in code:
             join = 'override'
 
+    # tracking_ids and time grid from the file headers, so bad stores fail before any concatenation
+    table_id = zarr.split('/')[-4]
+    heads = scan_headers(gfiles)
+    time_fixed = any(fix in code for code in codes for fix in ['fix_time','time_','360_day','noleap'])
+    if 'time' in ds.coords and not time_fixed:
+        okay, message = check_time_grid(heads, table_id)
+        dstr += message
+        if not okay:
+            return 'failure', None, dstr
+
+    # chunk sizes from the shape and dtype of the variable and the total length of all files
+    chunks = plan_chunks(gfiles, table_id, svar, nt=heads.nt.sum())
+
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore")
         try:
             if 'time' in ds.coords:   
-                    df7 = xr.open_mfdataset(gfiles, preprocess=preprocess, data_vars='minimal', chunks={'time': chunksize},
+                    df7 = xr.open_mfdataset(gfiles, preprocess=preprocess, data_vars='minimal', chunks=chunks,
                                             use_cftime=True, join=join, combine='nested', concat_dim='time')
             else: # fixed in time, no time grid
                 df7 = xr.open_mfdataset(gfiles, preprocess=set_bnds_as_coords, combine='by_coords', join=join, data_vars='minimal')
         except:
             dstr += '\nerror in open_mfdataset'
                 
-    for code in codes:
-        if 'drop_tb' in code: # to_zarr cannot do chunking with time_bounds/time_bnds which is cftime (an object, not float)
-            timeb = [var for var in df7.coords if 'time_bnds' in var or 'time_bounds' in var][0]
-            df7 = df7.drop(timeb)
-        if 'time_' in code:
-            [y1,y2] = code.split('_')[-1].split('-')
-            df7 = df7.sel(time=slice(str(y1)+'-01-01',str(y2)+'-12-31'))
-        if '360_day' in code:
-            year = gfiles[0].split('-')[-2][-6:-2]
-            df7['time'] = cftime.num2date(np.arange(df7.time.shape[0]), units='months since '+year+'-01-16', calendar='360_day')
-            #print('encoding time as 360_day from year = ',year)
-        if 'noleap' in code:
-            year = gfiles[0].split('-')[-2][-6:-2]
-            df7['time'] = xr.cftime_range(start=year, periods=df7.time.shape[0], freq='MS', calendar='noleap').shift(15, 'D')
-            #print('encoding time as noleap from year = ',year)
-        if 'missing' in code:
-            del df7[svar].encoding['missing_value']
-
-    #     check time grid to make sure there are no gaps in concatenated data (open_mfdataset checks for mis-ordering)
-    if 'time' in ds.coords:
-        table_id = zarr.split('/')[-3]
+    df7 = fix_dataset(codes, df7, gfiles, svar)
+
+    #     check time grid of the fixed time axis (otherwise already done on the file headers)
+    if 'time' in ds.coords and time_fixed:
         year = sorted(list(set(df7.time.dt.year.values)))
-        print(np.diff(year).sum(), len(year))
-        if '3hr' in table_id:
-            if not (np.diff(year).sum() == len(year)-1) | (np.diff(year).sum() == len(year)-2):
-                dstr += '\ntrouble with 3hr time grid'
-                return 'failure', df7, dstr
-        elif 'dec' in table_id:
-            if not (np.diff(year).sum()/10 == len(year)) | (np.diff(year).sum()/10 == len(year)-1):
-                dstr += '\ntrouble with dec time grid'
-                return 'failure',df7, dstr
-        else:
-            if not np.diff(year).sum() == len(year)-1:
-                dstr += '\ntrouble with grid'
-                return 'failure',df7, dstr
-
-    dsl = xr.open_dataset(gfiles[0])
-    tracking_id = dsl.tracking_id
-    if len(gfiles) > 1:
-        for file in gfiles[1:]:
-            dsl = xr.open_dataset(file)
-            tracking_id = tracking_id+'\n'+dsl.tracking_id
-    df7.attrs['tracking_id'] = tracking_id
+        if not years_ok(year, table_id):
+            dstr += f'\ntrouble with {table_id} time grid'
+            return 'failure',df7, dstr
+
+    df7.attrs['tracking_id'] = '\n'.join(heads.tracking_id)
 
     date = str(datetime.datetime.now().strftime("%Y-%m-%d"))
     nstatus = date + ';created; by gcs.cmip6.ldeo@gmail.com'
     df7.attrs['status'] = nstatus
     
-    if 'time' in df7.coords:
-        nt = len(df7.time.values)
-        chunksize = min(chunksize,int(nt/2))
-        df7 = df7.chunk(chunks={'time' : chunksize})   # yes, do it again
+    if 'time' in df7.coords and 'time' in chunks:
+        chunks['time'] = min(chunks['time'], len(df7.time.values))
+        chunks = {dim: size for dim, size in chunks.items() if dim in df7.dims}   # fixes may rename dims
+        df7 = df7.chunk(chunks=chunks)   # files do not end on chunk boundaries
 
     return 'success', df7, dstr
 
+def write_zarr(ds, zbdir, max_block=1e9):
+    '''write ds to a new zarr store in blocks of whole time chunks, appending along time'''
+    # Only one block (at most max_block bytes, but at least one chunk) is computed at a time,
+    # so the memory and dask graph stay small for long 3hr/6hr stores. Blocks are multiples
+    # of the time chunk of ds, so every block fills whole zarr chunks.
+    # (variables without time, e.g. lat_bnds, are small and simply rewritten with each block)
+    if 'time' not in ds.dims or ds.chunks is None or 'time' not in ds.chunks:
+        ds.to_zarr(zbdir, consolidated=True, mode='w')
+        return
+
+    nt = ds.dims['time']
+    chunk = ds.chunks['time'][0]
+    ds = ds.chunk({'time': chunk})      # the last chunk may be shorter, but no others
+    step_bytes = sum(ds[var].dtype.itemsize * ds[var].size / nt
+                     for var in ds.variables if 'time' in ds[var].dims)
+    block = max(int(max_block // (step_bytes * chunk)), 1) * chunk
+
+    # .zmetadata is only written once the last block is on disk, so an interrupted write never
+    # looks like a finished store
+    for start in range(0, nt, block):
+        dsb = ds.isel(time=slice(start, start + block))
+        if start == 0:
+            dsb.to_zarr(zbdir, consolidated=False, mode='w')
+        else:
+            dsb.to_zarr(zbdir, consolidated=False, append_dim='time')
+    zarr.consolidate_metadata(zbdir)
+
+code_keys = ['source_id','experiment_id','member_id','table_id','variable_id','grid_label']
+
+class CodeIndex:
+    '''reason_codes of the rules in csv/exceptions.csv, indexed by dataset ('all' matches anything)'''
+    # A rule is stored under its six key values, with 'all' left in place. A dataset is looked up
+    # once for each combination of 'all' columns used by any rule, so a lookup costs a handful of
+    # dict accesses however many rules there are. The csv is read again whenever it changes.
+    # The pipeline looks codes up from several threads: the rules and masks are built aside and
+    # swapped in together under the lock, so a lookup never sees a half-read csv.
+
+    def __init__(self, file='csv/exceptions.csv'):
+        self.file = file
+        self.mtime = None
+        self._index = ({}, [])
+        self._lock = threading.Lock()
+
+    def _load(self):
+        '''(rules, masks) of the current csv'''
+        mtime = os.path.getmtime(self.file)
+        with self._lock:
+            if mtime != self.mtime:
+                dex = pd.read_csv(self.file,skipinitialspace=True)
+                rules = {}
+                masks = set()
+                for order, ex in enumerate(dex[code_keys + ['reason_code']].values):
+                    key = tuple(ex[:-1])
+                    rules.setdefault(key, []).append((order, ex[-1]))
+                    masks.add(tuple(value == 'all' for value in key))
+                self._index = (rules, sorted(masks))
+                self.mtime = mtime
+            return self._index
+
+    def codes(self, key):
+        '''codes for key = (source_id, experiment_id, member_id, table_id, variable_id, grid_label)'''
+        rules, masks = self._load()
+        found = set()
+        for mask in masks:
+            rule = tuple('all' if wild else value for wild, value in zip(mask, key))
+            found.update(rules.get(rule, []))
+        return [code for order, code in sorted(found)]     # in csv order
+
+    def lookup(self, df):
+        '''Series with the list of codes for each row of df (which has the code_keys columns)'''
+        self._load()
+        keys = list(zip(*[df[key] for key in code_keys]))
+        codes = {key: self.codes(key) for key in set(keys)}
+        return pd.Series([codes[key] for key in keys], index=df.index)
+
+_code_index = CodeIndex()
+
 def read_codes(zarr):
-    dex = pd.read_csv('csv/exceptions.csv',skipinitialspace=True)
-    codes = []
-    [source_id,experiment_id,member_id,table_id,variable_id,grid_label] = zarr.split('/')
-    for ex in dex.values:
-        dd = dict(zip(dex.keys(),ex))
-        if dd['source_id'] == source_id or dd['source_id'] == 'all':
-            if dd['experiment_id'] == experiment_id or dd['experiment_id'] == 'all':
-                if dd['member_id'] == member_id or dd['member_id'] == 'all':
-                    if dd['table_id'] == table_id or dd['table_id'] == 'all':
-                        if dd['variable_id'] == variable_id or dd['variable_id'] == 'all':
-                            if dd['grid_label'] == grid_label or dd['grid_label'] == 'all':  
-                                codes += [dd['reason_code']]
-                                print('special treatment needed:',dd['reason_code'])
+    codes = _code_index.codes(tuple(zarr.split('/')))
+    for code in codes:
+        print('special treatment needed:',code)
     return codes
-
@@ -0,0 +1,299 @@
+"""Overlapping download / convert / upload of many zarr stores
+
+   The nb1-DataRequests main loop as a module: while store N is being concatenated and
+   written, the netcdf files of the next stores are downloaded and store N-1 is uploaded.
+   Each stage has its own pool of worker threads and the stages are connected by
+   bounded queues, so downloads never run more than max_queued stores ahead.
+   With a jobs.JobStore, every stage reached is recorded and a restarted run carries on
+   where the last one stopped.
+
+   usage: python pipeline.py csv/needed.csv --zarr-local /d1/naomi/cmip6-zarrs --log txt/request.log
+   (the needed list as csv or, keeping the replica_urls lists as they are, parquet)
+"""
+
+import os
+import re
+import sys
+import time
+import queue
+import argparse
+import threading
+import pandas as pd
+import xarray as xr
+
+from netcdf import get_ncfiles, concatenate, write_zarr
+from response import get_details, dict_to_dfcat
+from utilities import getFolderSize
+from download import HostStats, NcCache
+from jobs import JobStore, stages as job_stages
+from catalog import cloud_catalog, CatalogIndex
+
+_log_lock = threading.Lock()
+
+# open and close for each write in case of kernel interrupt
+def write_log(file,str,verbose=True):
+    with _log_lock:
+        if verbose:
+            print(str)
+        if file is not None:
+            f = open(file,'a')
+            f.write(str+'\n')
+            f.close()
+    return
+
+def _gcs():
+    import gcsfs
+    return gcsfs.GCSFileSystem(token='anon', access='read_only')
+
+class Pipeline:
+    '''download, convert and upload zarr stores with separate network and CPU worker pools'''
+
+    def __init__(self, df_needed, zarr_local, skip_sites=[], log_file=None, df_GCS=None, fs=None,
+                 net_workers=2, cpu_workers=1, upload_workers=1, max_queued=2,
+                 jobs=None, stats=None, cache=None, execute=False, verbose=True):
+        # df_needed - files of the needed stores (from identify.needed)
+        # df_GCS - cloud catalog, stores already listed are skipped
+        # jobs - JobStore recording the progress of each store (None: no record)
+        # stats, cache - download.HostStats and NcCache shared by all the stores (None: the
+        #                defaults in cache/), so node limits and statistics hold for the whole run
+        # execute=False only logs the gsutil upload commands (as the notebook does)
+        self.df_needed = df_needed
+        self.zarr_local = zarr_local
+        self.skip_sites = skip_sites
+        self.log_file = log_file
+        self.df_GCS = df_GCS
+        self.in_catalog = set() if df_GCS is None else CatalogIndex(df_GCS)
+        self.fs = _gcs() if fs is None else fs
+        self.workers = [net_workers, cpu_workers, upload_workers]
+        self.max_queued = max_queued
+        self.jobs = jobs
+        self.stats = HostStats() if stats is None else stats
+        self.cache = NcCache() if cache is None else cache
+        self.execute = execute
+        self.verbose = verbose
+        self.zdict = {}
+
+    def log(self, str):
+        write_log(self.log_file, str, verbose=self.verbose)
+
+    def record(self, zarr, stage, started, details=None, message=''):
+        if self.jobs is not None:
+            self.jobs.record(zarr, stage, started=started, details=details, message=message)
+
+    def next_stage(self, zarr):
+        '''the stage zarr was working on (the one after the last stage it reached)'''
+        reached = None if self.jobs is None else self.jobs.stage(zarr)
+        return job_stages[0] if reached is None else job_stages[min(job_stages.index(reached)+1, len(job_stages)-1)]
+
+    def fail(self, zarr, stage, message):
+        self.log(f'{zarr}: {message}')
+        if self.jobs is not None:
+            self.jobs.fail(zarr, stage, message)
+
+    # stage 1: network
+    def fetch(self, item, zarr):
+        zbdir = self.zarr_local + zarr
+        gsurl = 'gs://cmip6' + zarr
+        self.log(f"\n>>{item+1}/{self.num_stores}:<< local file: {zbdir}")
+
+        # is zarr already in cloud?
+        try:
+            contents = self.fs.ls(gsurl)
+        except FileNotFoundError:
+            contents = []
+        if any("zmetadata" in s for s in contents):
+            self.log(f'{zarr}: store already in cloud')
+            self.record(zarr, 'verified', None, message='already in cloud')
+            return None
+        if gsurl in self.in_catalog:
+            self.log(f'{zarr}: store already in cloud catalog')
+            return None
+
+        # a local store left by an earlier run is only trusted if the JobStore has it as written
+        # (run() sends those straight to the upload); anything else is written again from scratch
+        if os.path.isdir(zbdir):
+            self.log(f'{zarr}: incomplete local store, writing it again')
+
+        # Download the needed netcdf files - reading the known trouble codes from database
+        started = time.time()
+        gfiles,troubles,codes,okay = get_ncfiles(zarr,self.df_needed,self.skip_sites,
+                                               stats=self.stats,cache=self.cache)
+        self.log(troubles)
+        if okay == False:
+            self.fail(zarr, 'downloaded', 'download failed ' + troubles.strip())
+            return None
+        if len(gfiles) == 0:
+            self.fail(zarr, 'downloaded', 'no files available')
+            return None
+        self.record(zarr, 'downloaded', started)
+        return item, zarr, sorted(gfiles), codes
+
+    # stage 2: CPU
+    def convert(self, item, zarr, gfiles, codes):
+        zbdir = self.zarr_local + zarr
+
+        # concatenate in time with mfdataset
+        started = time.time()
+        status, ds, dstr = concatenate(zarr,gfiles,codes)
+        if status == 'failure':
+            self.fail(zarr, 'concatenated', status+dstr)
+            return None
+        self.log(dstr)
+        self.record(zarr, 'concatenated', started)
+
+        # convert to zarr, with consolidated metadata - one block of time chunks at a time
+        started = time.time()
+        write_zarr(ds, zbdir)
+        if not os.path.isfile(zbdir+'/.zmetadata'):
+            self.fail(zarr, 'written', 'to_zarr failure')
+            return None
+
+        vlist = get_details(ds,zbdir,zarr)
+        self.record(zarr, 'written', started, details=vlist)
+        return item, zarr, gfiles, vlist
+
+    # stage 3: network
+    def upload(self, item, zarr, gfiles, vlist):
+        zbdir = self.zarr_local + zarr
+        gsurl = 'gs://cmip6' + zarr
+
+        command = '/usr/bin/gsutil -m cp -r '+ zbdir[:-1] + ' ' + gsurl[:-1]
+        self.log(command)
+        if not self.execute:
+            return None
+        started = time.time()
+        if os.system(command) != 0:
+            self.fail(zarr, 'uploaded', 'upload failed')
+            return None
+        self.record(zarr, 'uploaded', started)
+
+        started = time.time()
+        self.fs.invalidate_cache(gsurl)
+        size_remote = self.fs.du(gsurl)
+        size_local = getFolderSize(zbdir)
+        if abs(size_remote - size_local) >= 100:
+            self.fail(zarr, 'verified', f'uploaded size {size_remote} does not match local size {size_local}')
+            return None
+        self.log(f'uploaded {zbdir} correctly')
+
+        try:
+            xr.open_zarr(self.fs.get_mapper(gsurl), consolidated=True)
+        except Exception:
+            self.fail(zarr, 'verified', 'store did not get saved to GCS properly')
+            return None
+        self.record(zarr, 'verified', started)
+        self.zdict[item] = vlist
+        self.log(f'successfully saved as {zbdir}')
+        for gfile in gfiles:
+            os.system('rm -f '+ gfile)
+        return item
+
+    def _work(self, stage, inbox, outbox):
+        while True:
+            task = inbox.get()
+            if task is None:
+                inbox.put(None)     # let the other workers of this stage finish too
+                return
+            try:
+                result = stage(*task)
+            except Exception as e:
+                self.fail(task[1], self.next_stage(task[1]), f'{stage.__name__} failed: {e!r}')
+                result = None
+            if result is not None and outbox is not None:
+                outbox.put(result)  # blocks while the next stage is busy
+
+    def run(self, new_zarrs=None):
+        '''process the stores, returns the dict of new catalog rows (see response.dict_to_dfcat)'''
+        if new_zarrs is None:
+            new_zarrs = self.df_needed.zstore.unique()
+        self.new_zarrs = list(new_zarrs)
+        self.num_stores = len(new_zarrs)
+
+        stages = [self.fetch, self.convert, self.upload]
+        queues = [queue.Queue()] + [queue.Queue(maxsize=self.max_queued) for s in stages[1:]]
+        threads = []
+        for i, stage in enumerate(stages):
+            outbox = queues[i+1] if i+1 < len(stages) else None
+            threads += [[threading.Thread(target=self._work, args=(stage, queues[i], outbox), daemon=True)
+                         for n in range(self.workers[i])]]
+            for t in threads[-1]:
+                t.start()
+
+        # stores written (but not yet verified) by an earlier run go straight to the upload
+        resume = []
+        for item, zarr in enumerate(new_zarrs):
+            if self.jobs is not None and self.jobs.done(zarr, 'verified'):
+                self.log(f'{zarr}: done by an earlier run')
+                details = self.jobs.details(zarr)
+                if details is not None and not self.jobs.done(zarr, 'cataloged'):
+                    self.zdict[item] = details
+            elif self.jobs is not None and self.jobs.done(zarr, 'written'):
+                resume += [(item, zarr, [], self.jobs.details(zarr))]
+            else:
+                queues[0].put((item, zarr))
+        queues[0].put(None)
+        for task in resume:
+            queues[2].put(task)
+
+        # shut the stages down in order, once everything upstream is done
+        for i, stage_threads in enumerate(threads):
+            for t in stage_threads:
+                t.join()
+            if i+1 < len(queues):
+                queues[i+1].put(None)
+        return self.zdict
+
+    def cataloged(self, zdict=None):
+        '''record the stores of zdict (default: all new ones) as added to the catalog'''
+        if self.jobs is None:
+            return
+        for item in (self.zdict if zdict is None else zdict):
+            self.jobs.record(self.new_zarrs[item], 'cataloged', None)
+
+def run_pipeline(df_needed, zarr_local, new_zarrs=None, **kwargs):
+    '''process the stores in df_needed, see Pipeline for the options'''
+    return Pipeline(df_needed, zarr_local, **kwargs).run(new_zarrs)
+
+def _url_list(value):
+    # replica_urls written by to_csv: "['http://...', 'http://...']" (or "['...' '...']" from an array)
+    return re.findall(r"'([^']*)'", value)
+
+def read_needed(file):
+    '''the needed files list (as from identify.needed) from a parquet or csv file'''
+    if file.endswith('.parquet'):
+        return pd.read_parquet(file)
+    return pd.read_csv(file, converters={'replica_urls': _url_list})
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='download, convert and upload needed zarr stores')
+    parser.add_argument('needed', help='csv or parquet file of the needed netcdf files (with a zstore column)')
+    parser.add_argument('--zarr-local', required=True, help='local directory for the new zarr stores')
+    parser.add_argument('--log', default=None, help='log file')
+    parser.add_argument('--catalog', default=None, help='csv file for the catalog rows of the new stores')
+    parser.add_argument('--skip-site', action='append', default=[], help='data node to avoid')
+    parser.add_argument('--net-workers', type=int, default=2)
+    parser.add_argument('--cpu-workers', type=int, default=1)
+    parser.add_argument('--upload-workers', type=int, default=1)
+    parser.add_argument('--max-queued', type=int, default=2)
+    parser.add_argument('--jobs', default='txt/jobs.sqlite', help='job state database (resumes from it)')
+    parser.add_argument('--execute', action='store_true', help='really upload to GCS')
+    args = parser.parse_args(args)
+
+    df_needed = read_needed(args.needed)
+    df_GCS = cloud_catalog()
+    jobs = JobStore(args.jobs)
+    start = time.time()
+    pipeline = Pipeline(df_needed, args.zarr_local, skip_sites=args.skip_site, log_file=args.log,
+                        df_GCS=df_GCS, net_workers=args.net_workers, cpu_workers=args.cpu_workers,
+                        upload_workers=args.upload_workers, max_queued=args.max_queued,
+                        jobs=jobs, execute=args.execute)
+    zdict = pipeline.run()
+    print(f'{len(zdict)} new stores in {time.time()-start:.0f} s')
+    print(jobs.stats())
+    if args.catalog is not None and len(zdict) > 0:
+        dict_to_dfcat(zdict).to_csv(args.catalog, index=False)
+        pipeline.cataloged()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
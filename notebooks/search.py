@@ -3,73 +3,145 @@
 
 from __future__ import print_function
 
+import os
+import json
+import time
+import hashlib
 import warnings
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import dask
 import requests
 import pandas as pd
 from collections import OrderedDict
 
-# API AT: https://github.com/ESGF/esgf.github.io/wiki/ESGF_Search_REST_API
-
-def _check_doc_for_malformed_id(d):
-    source_id = d['source_id'][0]
-    expt_id = d['experiment_id'][0]
-    if not  f"{source_id}_{expt_id}" in d['id']:
-        raise ValueError(f"Dataset id {d['id']} is malformed")
+from fileio import write_atomic, write_json
 
-def _maybe_squeze_values(d):
-    def _maybe_squeeze(value):
-        if isinstance(value, str):
-            return value
-        try:
-            if len(value)==1:
-                return value[0]
-        except TypeError:
-            return(value)
-    return {k: _maybe_squeeze(v) for k, v in d.items()}
+# API AT: https://github.com/ESGF/esgf.github.io/wiki/ESGF_Search_REST_API
 
-def _get_request(server, verbose=False, **payload):
-    client = requests.session()
+# facets stored as categoricals - few distinct values repeated over many files
+_facets = ['mip_era','activity_drs','activity_id','institution_id','source_id','experiment_id',
+           'member_id','table_id','variable_id','grid_label','frequency','realm','nominal_resolution',
+           'variant_label','sub_experiment_id','product','project','data_node','index_node',
+           'replica','latest','type','checksum_type','version']
+
+def _well_formed_ids(df):
+    # the dataset id must contain {source_id}_{experiment_id}
+    source_id = df.source_id.str[0]
+    expt_id = df.experiment_id.str[0]
+    return pd.Series([f"{s}_{e}" in i for s, e, i in zip(source_id, expt_id, df['id'])],
+                     index=df.index)
+
+def _squeeze_column(col):
+    # single valued lists become scalars, other lists become None (strings and numbers are kept)
+    if col.dtype != object:
+        return col
+    is_list = col.map(lambda v: isinstance(v, (list, tuple)))
+    if not is_list.any():
+        return col
+    single = is_list & (col.str.len() == 1)
+    return col.where(~is_list, None).where(~single, col.str[0])
+
+def _collect_replicas(df, keep='first'):
+    '''one row per checksum, with the HTTPServer_url of every copy in replica_urls'''
+    if 'replica_urls' in df:
+        urls = df[['checksum','replica_urls']].explode('replica_urls')
+    elif 'HTTPServer_url' not in df:
+        return df.drop_duplicates(subset='checksum', keep=keep)
+    else:
+        urls = df[['checksum','HTTPServer_url']]
+    urls = urls.set_axis(['checksum','url'], axis=1).dropna().drop_duplicates()
+    replicas = urls.groupby('checksum', sort=False)['url'].agg(list)
+    # dropping duplicates on checksum removes all identical files
+    df = df.drop_duplicates(subset='checksum', keep=keep)
+    return df.assign(replica_urls=df.checksum.map(replicas))
+
+def _as_categoricals(df):
+    for key in _facets:
+        if key in df and df[key].dtype == object:
+            df[key] = df[key].astype('category')
+    return df
+
+# one pooled session per index node, shared by all pages (and threads) of all searches
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _get_session(server, pool_size=10):
+    node = urlsplit(server).netloc
+    with _sessions_lock:
+        client = _sessions.get(node)
+        if client is None:
+            client = requests.session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            client.mount('https://', adapter)
+            client.mount('http://', adapter)
+            _sessions[node] = client
+    return client
+
+def _get_request(server, verbose=False, timeout=None, **payload):
+    client = _get_session(server)
     url_keys = []
     url_keys = ["{}={}".format(k, payload[k]) for k in payload]
     url = "{}/?{}".format(server, "&".join(url_keys))
     if verbose:
         print(url)
-    r = client.get(url)
+    r = client.get(url, timeout=timeout)
     r.raise_for_status()
     resp = r.json()["response"]
     return resp
 
+def _empty_page(df):
+    # no usable docs on the page: no rows, but the columns of a page with some
+    cols = [col for col in df.columns if col != 'url']
+    return pd.DataFrame(columns=cols + [col for col in ['HTTPServer_url','version','file_name'] if col not in cols])
+
+def _docs_to_dataframe(docs, filter_server_url=None):
+    '''ESGF File docs to a DataFrame, one row per file with one column per access service'''
+    if len(docs) == 0:
+        return pd.DataFrame()
+    df = pd.DataFrame(docs)
+    df = df[_well_formed_ids(df)]
+    if len(df) == 0:
+        return _empty_page(df)
+
+    # explode the 'url|mime_type|service_type' lists once, then one column per service
+    urls = df.pop('url').explode().dropna().str.split('|', expand=True)
+    if len(urls) == 0:
+        return _empty_page(df)
+    access_url, service_type = urls[0], urls[2]
+    opendap = service_type == 'OPENDAP'
+    access_url = access_url.where(~opendap, access_url.str.replace('.html', '', regex=False))
+    if filter_server_url is not None:
+        keep = access_url.str.contains(filter_server_url, regex=False)
+        access_url, service_type = access_url[keep], service_type[keep]
+    access = pd.DataFrame({'doc': access_url.index, 'service': service_type.values + '_url',
+                           'access_url': access_url.values})
+    access = access.drop_duplicates(['doc', 'service'], keep='last')
+    access = access.pivot(index='doc', columns='service', values='access_url')
+    access.columns.name = None
+
+    # docs without any (matching) url are dropped
+    df = df.apply(_squeeze_column).loc[access.index].join(access)
+    if 'size' in df:
+        df['size'] = pd.to_numeric(df['size'])
+    if 'HTTPServer_url' in df:
+        path = df.HTTPServer_url.str.rsplit('/', n=2)
+        df['version'] = path.str[-2]
+        df['file_name'] = path.str[-1]
+    return df.reset_index(drop=True)
+
 def _get_page_dataframe(server, expected_size, offset=0,
-                        filter_server_url=None, verbose=False,
+                        filter_server_url=None, verbose=False, timeout=None,
                         **payload):
 
-    resp = _get_request(server, offset=offset, verbose=verbose, **payload)
+    resp = _get_request(server, offset=offset, verbose=verbose, timeout=timeout, **payload)
 
     docs = resp["docs"]
     assert len(docs) == expected_size
 
-    all_files = []
-    for d in docs:
-        try:
-            _check_doc_for_malformed_id(d)
-        except ValueError:
-            continue
-        dataset_id = d['dataset_id']
-        item = OrderedDict(dataset_id=dataset_id, id=d['id'])
-        target_urls = d.pop('url')
-        item.update(_maybe_squeze_values(d))
-        for f in target_urls:
-            access_url, mime_type, service_type = f.split("|")
-
-            if service_type == 'OPENDAP':
-                access_url = access_url.replace('.html', '')
-            if filter_server_url is None or filter_server_url in access_url:
-                item.update({f'{service_type}_url': access_url})
-                all_files.append(item)
-
-    return pd.DataFrame(all_files)
+    return _docs_to_dataframe(docs, filter_server_url=filter_server_url)
 
 
 _get_page_dataframe_d = dask.delayed(_get_page_dataframe)
@@ -92,8 +164,9 @@ def esgf_search(server="https://esgf-node.llnl.gov/esg-search/search",
                 # this option should not be necessary with local_node=True
                 filter_server_url=None, local_node=False,
                 verbose=False, format="application%2Fsolr%2Bjson",
-                use_csrf=False, delayed=False, **search):
-
+                use_csrf=False, delayed=False, max_workers=4, timeout=None, **search):
+    # max_workers - maximum number of pages in flight at once (1 = serial)
+    # timeout - seconds (or (connect, read) tuple) to wait for each page, None waits forever
 
     payload = search
     #payload["project"] = project
@@ -108,35 +181,41 @@ def esgf_search(server="https://esgf-node.llnl.gov/esg-search/search",
     payload["latest"] = "true"
 #    payload["distrib"]= "true"
 
+    _get_session(server, pool_size=max(max_workers, 10))
+
     init_resp = _get_request(server, offset=0, limit=page_size,
-                            verbose=verbose, **payload)
+                            verbose=verbose, timeout=timeout, **payload)
                          
     num_found = int(init_resp["numFound"])
-                         
-    if delayed:
-        page_function = _get_page_dataframe_d
-    else:
-        page_function = _get_page_dataframe
+    if num_found == 0:
+        return pd.DataFrame()
 
-    all_frames = []
-    for offset in range(0, num_found, page_size):
+    # the first page came back with the initial request, no need to ask again
+    all_frames = [_docs_to_dataframe(init_resp["docs"], filter_server_url=filter_server_url)]
 
+    def page_args(offset):
         expected_size = (page_size if offset <= (num_found - page_size)
                          else (num_found - offset))
-        df_d = page_function(server, expected_size, limit=page_size, offset=offset,
-                             verbose=verbose,
-                             filter_server_url=filter_server_url,
-                             **payload)
+        return (server, expected_size)
 
-        all_frames.append(df_d)
+    offsets = range(page_size, num_found, page_size)
+    kwargs = dict(limit=page_size, verbose=verbose, timeout=timeout,
+                  filter_server_url=filter_server_url, **payload)
 
     if delayed:
-        all_frames = dask.compute(*all_frames)
+        pages = [_get_page_dataframe_d(*page_args(offset), offset=offset, **kwargs)
+                 for offset in offsets]
+        all_frames += dask.compute(*pages, scheduler='threads', num_workers=max_workers)
+    else:
+        def get_page(offset):
+            return _get_page_dataframe(*page_args(offset), offset=offset, **kwargs)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            all_frames += list(pool.map(get_page, offsets))
                          
-    dfa = pd.concat(all_frames,sort=True)
+    dfa = pd.concat(all_frames,sort=True,ignore_index=True)
                          
-    # dropping duplicates on checksum removes all identical files
-    return dfa.drop_duplicates(subset='checksum')
+    # all copies of a file are kept in replica_urls
+    return _as_categoricals(_collect_replicas(dfa))
 
 def esgf_search_sites():
     dtype = {}
@@ -148,169 +227,260 @@ def esgf_search_sites():
     dtype['dkrz'] =  "https://esgf-data.dkrz.de/esg-search/search"        # no historical
     return dtype
 
-def search(server, df_req, local_node=False, verbose=False):
-    df_list = []
-    for index, row in df_req.iterrows():
-        timestamp = row['Timestamp']
-        name = row['requester']
-        email = row['E-mail']
-        experiment_ids = row['experiments']
-        source_ids = row['models']
-        variable_ids = row['variables']
-        table_id = row['table']
-        print('\n'+email)
-        if experiment_ids[0] == 'All':
-            for variable_id in variable_ids:        
-                if source_ids[0] == 'All':
-                    print(table_id,variable_id,source_ids,experiment_ids)
-                    try:
-                        files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                table_id=table_id, page_size=500, verbose=verbose, local_node=False)
-                    except:
-                        continue
-
-                    files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                    files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                    # might need to set activity_id to activity_drs for some files (see old versions)
-                    files.loc[:,'activity_id'] = files.activity_drs
-
-                    df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
-                else:
-                    for source_id in source_ids:
-                        print(table_id,variable_id,source_id,experiment_ids)
-                        try:
-                            files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                    table_id=table_id, source_id = source_id, page_size=500, verbose=verbose, local_node=False)
-                        except:
-                            continue
-
-                        files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                        files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                        # might need to set activity_id to activity_drs for some files (see old versions)
-                        files.loc[:,'activity_id'] = files.activity_drs
-
-                        df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
+def _node_failed(e):
+    # timeouts, refused connections and 5xx mean: try another node
+    if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return False
+
+# last ranking of the index nodes: (time of probe, [(name, latency), ...])
+_node_ranking = {}
+
+def probe_nodes(sites=None, timeout=10, probe_ttl=300, verbose=False):
+    '''healthy index nodes, fastest first, as a list of (name, seconds)'''
+    # a node is probed with an empty (limit=0) local search; rankings are reused for probe_ttl seconds
+    if sites is None:
+        sites = esgf_search_sites()
+    key = tuple(sorted(sites.items()))
+    if key in _node_ranking and time.time() - _node_ranking[key][0] < probe_ttl:
+        return _node_ranking[key][1]
+
+    def probe(name):
+        start = time.time()
+        try:
+            _get_request(sites[name], timeout=timeout, limit=0, type='File', project='CMIP6',
+                         distrib='false', format="application%2Fsolr%2Bjson")
+        except Exception as e:
+            if verbose:
+                print('index node',name,'is not healthy:',e)
+            return None
+        return time.time() - start
+
+    with ThreadPoolExecutor(max_workers=len(sites)) as pool:
+        latencies = list(pool.map(probe, sites))
+    ranking = sorted([(name, latency) for name, latency in zip(sites, latencies) if latency is not None],
+                     key=lambda nl: nl[1])
+    if verbose:
+        for name, latency in ranking:
+            print(f'index node {name}: {latency:.2f} s')
+    _node_ranking[key] = (time.time(), ranking)
+    return ranking
+
+def federated_search(sites=None, merge=False, timeout=(10, 300), verbose=False, **search):
+    '''esgf_search on the fastest healthy index node, falling back to the next on timeouts or 5xx'''
+    # merge=True asks every healthy node for its own (local) files instead and merges them,
+    # one row per checksum with all copies in replica_urls, as esgf_search does
+    if sites is None:
+        sites = esgf_search_sites()
+    ranking = probe_nodes(sites, verbose=verbose)
+    if len(ranking) == 0:
+        raise RuntimeError('no healthy ESGF index node')
+
+    if merge:
+        search['local_node'] = True
+        def search_node(name):
+            try:
+                return esgf_search(server=sites[name], timeout=timeout, verbose=verbose, **search)
+            except Exception as e:
+                if not _node_failed(e):
+                    raise
+                print('index node',name,'failed:',e)
+                return pd.DataFrame()
+        with ThreadPoolExecutor(max_workers=len(ranking)) as pool:
+            frames = list(pool.map(search_node, [name for name, latency in ranking]))
+        dfa = pd.concat(frames, sort=True, ignore_index=True)
+        if len(dfa) == 0:
+            return dfa
+        return _as_categoricals(_collect_replicas(dfa))
+
+    for name, latency in ranking:
+        try:
+            return esgf_search(server=sites[name], timeout=timeout, verbose=verbose, **search)
+        except Exception as e:
+            if not _node_failed(e):
+                raise
+            print('index node',name,'failed, trying the next one:',e)
+            # probe again next time
+            _node_ranking.pop(tuple(sorted(sites.items())), None)
+    raise RuntimeError('all ESGF index nodes failed')
+
+def _any_search(server, **search):
+    # server=None searches the fastest healthy index node
+    if server is None:
+        return federated_search(**search)
+    return esgf_search(server=server, **search)
+
+def _cache_key(server, search):
+    '''normalized facet query and index node'''
+    # facet order and the order of comma-separated values do not matter
+    facets = {k: ','.join(sorted(str(v).split(','))) for k, v in search.items()}
+    query = '&'.join(f'{k}={facets[k]}' for k in sorted(facets))
+    node = 'federated' if server is None else urlsplit(server).netloc
+    return node + '?' + query
+
+def _latest_versions(df):
+    # keep only the newest version of each dataset (older ones are no longer 'latest')
+    dataset = df.dataset_id.str.split('|').str[0]
+    version = dataset.str.rsplit('.', n=1).str[-1]
+    master = dataset.str.rsplit('.', n=1).str[0]
+    return df[version == version.groupby(master).transform('max')]
+
+def cached_esgf_search(server="https://esgf-node.llnl.gov/esg-search/search",
+                       cache_dir='cache/esgf', ttl=None, max_age=7*24*3600, refresh=False,
+                       page_size=500, local_node=False, verbose=False, **search):
+    '''esgf_search with a persistent (parquet) cache, keyed by facet query and index node'''
+    # entries younger than ttl seconds are used as is; older ones are refreshed by asking
+    # only for records with a _timestamp after the newest one already in the cache.
+    # ttl=None keeps the entry's own ttl (12 hours for new entries).
+    # The refresh only adds records, so datasets retracted since are only dropped by a full
+    # search: one runs when the last was more than max_age seconds ago, or with refresh=True.
+    os.makedirs(cache_dir, exist_ok=True)
+    query = _cache_key(server, dict(search, local_node=local_node))
+    key = hashlib.sha1(query.encode()).hexdigest()
+    data_file = f'{cache_dir}/{key}.parquet'
+    meta_file = f'{cache_dir}/{key}.json'
+
+    meta = None
+    if not refresh and os.path.isfile(meta_file) and os.path.isfile(data_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if time.time() - meta.get('built', meta['fetched']) > max_age:
+            if verbose:
+                print('cached search too old, searching again:', query)
+            meta = None
+
+    if ttl is None:
+        ttl = meta['ttl'] if meta is not None else 12*3600
+
+    if meta is not None and time.time() - meta['fetched'] < ttl:
+        if verbose:
+            print('using cached search:', query)
+        return pd.read_parquet(data_file)
+
+    fetched = time.time()
+    built = fetched if meta is None else meta.get('built', meta['fetched'])
+    if meta is None:
+        dfa = _any_search(server, page_size=page_size, local_node=local_node,
+                          verbose=verbose, **search)
+    else:
+        dold = pd.read_parquet(data_file)
+        delta = dict(search)
+        delta['from'] = meta['timestamp']
+        dnew = _any_search(server, page_size=page_size, local_node=local_node,
+                           verbose=verbose, **delta)
+        if verbose:
+            print(f'refreshing cached search: {len(dnew)} new records for', query)
+        if len(dnew) > 0:
+            dfa = pd.concat([dold, dnew], sort=False, ignore_index=True)
+            dfa = _collect_replicas(_latest_versions(dfa), keep='last')
+            dfa = _as_categoricals(dfa)
         else:
-            for experiment_id in experiment_ids:
-                for variable_id in variable_ids:
-                    if source_ids[0] == 'All':
-                        print(table_id,variable_id,source_ids,experiment_id)
-                        try:
-                            files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                    table_id=table_id, experiment_id=experiment_id, page_size=500, verbose=verbose, local_node=False,)
-                        except:
-                            continue
-    
-                        files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                        files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                        # might need to set activity_id to activity_drs for some files (see old versions)
-                        files.loc[:,'activity_id'] = files.activity_drs
-    
-                        df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
-                    else:
-                        for source_id in source_ids:
-                            print(table_id,variable_id,source_id,experiment_id)
-                            try:
-                                files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                        table_id=table_id, experiment_id=experiment_id, source_id = source_id, page_size=500, verbose=verbose, local_node=False,)
-                            except:
-                                continue
-    
-                            files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                            files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                            # might need to set activity_id to activity_drs for some files (see old versions)
-                            files.loc[:,'activity_id'] = files.activity_drs
-
-                            df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
+            dfa = dold
 
-    dESGF = pd.concat(df_list,sort=False)
-    dESGF = dESGF.drop_duplicates(subset =["file_name","version","checksum"])
-    keys_all = list(dESGF.keys())
-    keys_show = ['activity_drs','institution_id',"source_id","experiment_id","member_id","table_id","variable_id",'grid_label']
-    keys_show += ["file_name",'HTTPServer_url','OPENDAP_url','tracking_id','size']
-    keys_drop = list(set(keys_all) - set(keys_show))
-    return dESGF.drop(keys_drop,1)
+    if len(dfa) == 0:
+        return dfa
 
-def search_new(server, df_req, local_node=False, verbose=False):
-    df_list = []
+    if '_timestamp' in dfa:
+        timestamp = dfa['_timestamp'].max()
+    else:
+        timestamp = datetime.utcfromtimestamp(fetched).strftime('%Y-%m-%dT%H:%M:%SZ')
+    meta = dict(query=query, fetched=fetched, built=built, ttl=ttl, timestamp=timestamp)
+
+    write_atomic(data_file, lambda tmp: dfa.to_parquet(tmp, index=False))
+    write_json(meta_file, meta)
+    return dfa
+
+def _batches(values, size):
+    values = list(values)
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
+def _plan_queries(df_req, max_values=20):
+    '''collapse the requests into a few multi-valued facet queries'''
+    # ESGF accepts comma-separated facet values, so all variables (experiments, sources) of
+    # the requests sharing a table and experiment/source lists go into one query.
+    # 'All' is simply a facet which is left out. max_values keeps the urls a sane length.
+    plan = OrderedDict()
     for index, row in df_req.iterrows():
-        timestamp = row['Timestamp']
-        name = row['requester']
-        email = row['E-mail']
         experiment_ids = row['experiments']
         source_ids = row['models']
-        variable_ids = row['variables']
         table_id = row['table']
-        print('\n'+email)
-        if experiment_ids[0] == 'All':
-            for variable_id in variable_ids:        
-                if source_ids[0] == 'All':
-                    print(table_id,variable_id,source_ids,experiment_ids)
-                    try:
-                        files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                table_id=table_id, page_size=500, verbose=verbose, local_node=False)
-                    except:
-                        continue
-
-                    files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                    files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                    # might need to set activity_id to activity_drs for some files (see old versions)
-                    files.loc[:,'activity_id'] = files.activity_drs
-
-                    df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
-                else:
-                    for source_id in source_ids:
-                        print(table_id,variable_id,source_id,experiment_ids)
-                        try:
-                            files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                    table_id=table_id, source_id = source_id, page_size=500, verbose=verbose, local_node=False)
-                        except:
-                            continue
-
-                        files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                        files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                        # might need to set activity_id to activity_drs for some files (see old versions)
-                        files.loc[:,'activity_id'] = files.activity_drs
-
-                        df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
-        else:
-            for experiment_id in experiment_ids:
-                for variable_id in variable_ids:
-                    if source_ids[0] == 'All':
-                        print(table_id,variable_id,source_ids,experiment_id)
-                        try:
-                            files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                    table_id=table_id, experiment_id=experiment_id, page_size=500, verbose=verbose, local_node=False,)
-                        except:
-                            continue
-    
-                        files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                        files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                        # might need to set activity_id to activity_drs for some files (see old versions)
-                        files.loc[:,'activity_id'] = files.activity_drs
-    
-                        df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
-                    else:
-                        for source_id in source_ids:
-                            print(table_id,variable_id,source_id,experiment_id)
-                            try:
-                                files= esgf_search(server=server, mip_era='CMIP6', variable_id=variable_id,
-                                        table_id=table_id, experiment_id=experiment_id, source_id = source_id, page_size=500, verbose=verbose, local_node=False,)
-                            except:
-                                continue
-    
-                            files.loc[:,'version'] = [str.split('/')[-2] for str in files['HTTPServer_url']]
-                            files.loc[:,'file_name'] = [str.split('/')[-1] for str in files['HTTPServer_url']]
-                            # might need to set activity_id to activity_drs for some files (see old versions)
-                            files.loc[:,'activity_id'] = files.activity_drs
-
-                            df_list += [files.drop_duplicates(subset =["file_name","version","checksum"]) ]
+        print('\n'+row['E-mail'])
+        experiments = () if experiment_ids[0] == 'All' else tuple(experiment_ids)
+        sources = () if source_ids[0] == 'All' else tuple(source_ids)
+        variables = plan.setdefault((table_id, experiments, sources), [])
+        variables += [v for v in row['variables'] if v not in variables]
+
+    queries = []
+    for (table_id, experiments, sources), variables in plan.items():
+        for variable_ids in _batches(variables, max_values):
+            for experiment_ids in _batches(experiments, max_values) or [[]]:
+                for source_ids in _batches(sources, max_values) or [[]]:
+                    facets = OrderedDict(table_id=table_id, variable_id=','.join(variable_ids))
+                    if experiment_ids:
+                        facets['experiment_id'] = ','.join(experiment_ids)
+                    if source_ids:
+                        facets['source_id'] = ','.join(source_ids)
+                    queries += [facets]
+    return queries
+
+def _split_by_facets(files, facets):
+    '''split the result of a multi-valued query back out by facet'''
+    # also drops anything the node returned which was not asked for
+    if len(files) == 0:
+        return OrderedDict()
+    for key, values in facets.items():
+        files = files[files[key].isin(values.split(','))]
+    keys = [key for key in ['table_id','variable_id','experiment_id','source_id'] if key in files]
+    return OrderedDict((k, v) for k, v in files.groupby(keys, sort=False, observed=True))
+
+def _search(server, df_req, keys_show, max_values=20, cache_dir=None, ttl=None, refresh=False, verbose=False):
+    df_list = []
+    for facets in _plan_queries(df_req, max_values=max_values):
+        print(*facets.values())
+        try:
+            if cache_dir is None:
+                files= _any_search(server, mip_era='CMIP6', page_size=500,
+                                   verbose=verbose, local_node=False, **facets)
+            else:
+                files= cached_esgf_search(server=server, cache_dir=cache_dir, ttl=ttl, refresh=refresh, mip_era='CMIP6',
+                                          page_size=500, verbose=verbose, local_node=False, **facets)
+        except:
+            continue
+
+        for key, dfs in _split_by_facets(files, facets).items():
+            if verbose:
+                print('  ', *key, len(dfs))
+            # version and file_name come from HTTPServer_url (see _docs_to_dataframe)
+            # might need to set activity_id to activity_drs for some files (see old versions)
+            dfs = dfs.assign(activity_id=dfs.activity_drs)
+
+            df_list += [dfs.drop_duplicates(subset =["file_name","version","checksum"]) ]
 
     dESGF = pd.concat(df_list,sort=False)
-    dESGF = dESGF.drop_duplicates(subset =["file_name","version","checksum"])
+    dESGF = _as_categoricals(dESGF.drop_duplicates(subset =["file_name","version","checksum"]))
     keys_all = list(dESGF.keys())
-    keys_show = ['activity_drs','institution_id',"source_id","experiment_id","member_id",
-                 "table_id","variable_id",'grid_label','version']
-    keys_show += ["file_name",'HTTPServer_url','OPENDAP_url','tracking_id','size']
     keys_drop = list(set(keys_all) - set(keys_show))
     return dESGF.drop(keys_drop,1)
+
+def search(server, df_req, local_node=False, verbose=False, max_values=20,
+           cache_dir='cache/esgf', ttl=None, refresh=False):
+    # server=None uses the fastest healthy node of esgf_search_sites() (see federated_search)
+    # cache_dir=None always searches ESGF from scratch, refresh=True rebuilds the cached searches
+    keys_show = ['activity_drs','institution_id',"source_id","experiment_id","member_id","table_id","variable_id",'grid_label']
+    keys_show += ["file_name",'HTTPServer_url','OPENDAP_url','tracking_id','size','checksum','checksum_type',
+                  'replica_urls']
+    return _search(server, df_req, keys_show, max_values=max_values,
+                   cache_dir=cache_dir, ttl=ttl, refresh=refresh, verbose=verbose)
+
+def search_new(server, df_req, local_node=False, verbose=False, max_values=20,
+               cache_dir='cache/esgf', ttl=None, refresh=False):
+    # server=None uses the fastest healthy node of esgf_search_sites() (see federated_search)
+    # cache_dir=None always searches ESGF from scratch, refresh=True rebuilds the cached searches
+    keys_show = ['activity_drs','institution_id',"source_id","experiment_id","member_id",
+                 "table_id","variable_id",'grid_label','version']
+    keys_show += ["file_name",'HTTPServer_url','OPENDAP_url','tracking_id','size','checksum','checksum_type',
+                  'replica_urls']
+    return _search(server, df_req, keys_show, max_values=max_values,
+                   cache_dir=cache_dir, ttl=ttl, refresh=refresh, verbose=verbose)
@@ -0,0 +1,44 @@
+import pandas as pd
+
+from search import _docs_to_dataframe
+
+def _doc(id, source_id='CESM2', experiment_id='historical'):
+    return {'id': id, 'source_id': [source_id], 'experiment_id': [experiment_id], 'size': 10,
+            'checksum': ['abc'],
+            'url': ['http://node/thredds/fileServer/CMIP6/v20190101/tas_Amon.nc|application/netcdf|HTTPServer']}
+
+def test_well_formed_page():
+    df = _docs_to_dataframe([_doc('CMIP6.CMIP.NCAR.CESM2_historical.tas_Amon.nc|node')])
+    assert len(df) == 1
+    assert df.version[0] == 'v20190101'
+    assert df.file_name[0] == 'tas_Amon.nc'
+
+def test_all_malformed_page():
+    # ids without {source_id}_{experiment_id}: the page is skipped, not an error
+    df = _docs_to_dataframe([_doc('CMIP6.CMIP.NCAR.tas_Amon.nc|node'), _doc('bad|node')])
+    assert len(df) == 0
+    for col in ['id', 'source_id', 'HTTPServer_url', 'version', 'file_name']:
+        assert col in df.columns
+    assert 'url' not in df.columns
+
+def test_malformed_docs_dropped():
+    df = _docs_to_dataframe([_doc('bad|node'), _doc('CMIP6.CMIP.NCAR.CESM2_historical.tas_Amon.nc|node')])
+    assert len(df) == 1
+    assert pd.concat([df, _docs_to_dataframe([_doc('bad|node')])]).shape[0] == 1
+
+def test_old_cache_searched_again(tmp_path, monkeypatch):
+    # the refresh only adds records: after max_age a retracted dataset must disappear
+    import time
+    import search
+    calls = []
+    def fake_search(server, **facets):
+        calls.append('from' in facets)
+        ids = ['a'] if len(calls) > 1 else ['a', 'retracted']
+        return pd.DataFrame({'id': ids, '_timestamp': ['2020-01-01T00:00:00Z'] * len(ids)})
+    monkeypatch.setattr(search, '_any_search', fake_search)
+    kw = dict(server=None, cache_dir=str(tmp_path), ttl=0, table_id='Amon')
+    assert len(search.cached_esgf_search(**kw)) == 2
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 8*24*3600)
+    assert list(search.cached_esgf_search(**kw).id) == ['a']
+    assert calls == [False, False]
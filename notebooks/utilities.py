@@ -1,45 +1,87 @@
+import numpy as np
 import pandas as pd
 import os
+import shutil
 import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import fsspec
 
+from listings import Listings
+from fileio import write_atomic, JsonCache
+
 import xarray as xr
-def add_time_info(df,verbose=False):
+import zarr
+
+class TimeCache(JsonCache):
+    '''time info of each store version (zstore + 'v' + version)'''
+    # a store version never changes, so it is only scanned once
+
+    def __init__(self, file='cache/time_info.json'):
+        super().__init__(file)
+
+    def get(self, vstore):
+        return self.values.get(vstore)
+
+    def put(self, vstore, value):
+        with self._lock:
+            self.values[vstore] = value
+
+time_keys = ['start', 'stop', 'nt', 'calendar', 'time_units', 'time_type']
+
+def scan_time(zstore):
+    '''start, stop, nt, calendar, time_units and time_type of a zstore, from its metadata'''
+    # Only .zmetadata and the chunks with the first and last times are read. The times are
+    # decoded as xr.open_zarr does, so time_type is numpy.datetime64 or the cftime class.
+    group = zarr.open_consolidated(fsspec.get_mapper(zstore), mode='r')
+    if 'time' not in group.array_keys():
+        return dict(start='NA', stop='NA', nt=1, calendar='NA', time_units='NA', time_type='NA')
+    time = group['time']
+    nt = time.shape[0]
+    units = time.attrs['units']
+    calendar = time.attrs.get('calendar', 'standard')
+    dates = xr.coding.times.decode_cf_datetime(time.get_coordinate_selection([0, nt-1]), units, calendar)
+    return dict(start=str(dates[0])[:10], stop=str(dates[-1])[:10], nt=nt, calendar=calendar,
+                time_units=units, time_type=str(type(dates[0])))
+
+def scan_times(zstores, versions=None, max_workers=16, cache=None, verbose=False):
+    '''scan_time of many zstores at once - DataFrame of zstore, the time_keys and error'''
+    # versions - the version of each zstore; only stores with a known version are cached
+    # (cache/time_info.json by default), as a store may be replaced by a newer version
+    if cache is None:
+        cache = TimeCache()
+    if versions is None:
+        versions = [None] * len(zstores)
+
+    def scan(zstore, version):
+        vstore = None if version is None or pd.isna(version) else f'{zstore}v{version}'
+        info = None if vstore is None else cache.get(vstore)
+        if info is None:
+            try:
+                info = scan_time(zstore)
+            except Exception as e:
+                print('no time info for', zstore, repr(e))
+                return dict(zstore=zstore, **{key: 'NA' for key in time_keys}, error=repr(e))
+            if vstore is not None:
+                cache.put(vstore, info)
+        if verbose:
+            print(zstore, info['start'], info['stop'], info['nt'])
+        return dict(zstore=zstore, **info, error='')
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(scan, list(zstores), list(versions)))
+    finally:
+        cache.save()
+    return pd.DataFrame(results, columns=['zstore'] + time_keys + ['error'])
+
+def add_time_info(df,verbose=False,max_workers=16,cache=None):
     '''add start, stop and nt for all zstores in df'''
-    starts = []; stops = []; nts = []; calendars = []; units = []; ttypes = []
+    versions = df.version.values if 'version' in df.columns else None
+    dt = scan_times(df.zstore.values, versions, max_workers=max_workers, cache=cache, verbose=verbose)
     dz = df.copy()
-    for index, row in df.iterrows():
-        zstore = row.zstore
-        ds = xr.open_zarr(fsspec.get_mapper(zstore),consolidated=True) 
-        start = 'NA'
-        start = 'NA'
-        nt = '1'
-        if 'time' in ds.coords:
-            ttype = str(type(ds.time.values[0]))
-            #dstime = ds.time.values
-            #start = str(dstime[0])[:10]
-            #stop = str(dstime[-1])[:10]
-            dstime = ds.time.values.astype('str')
-            start = dstime[0][:10]
-            stop = dstime[-1][:10]
-            calendar = ds.time.encoding['calendar']
-            unit = ds.time.encoding['units']
-            nt = len(dstime)
-            if verbose:
-                print(zstore,start,stop,nt)
-        starts += [start]
-        stops += [stop]
-        nts += [nt]
-        calendars += [calendar]
-        units += [unit]
-        ttypes += [ttype]
-
-    dz['start'] = starts
-    dz['stop'] = stops
-    dz['nt'] = nts
-    dz['calendar'] = calendars
-    dz['time_units'] = units
-    dz['time_type'] = ttypes
+    for key in time_keys:
+        dz[key] = dt[key].values
     return dz
 
 # define a simple search on keywords
@@ -118,21 +160,16 @@ def remove_from_GC_bucket(gsurl,execute=False):
     return
 
 def remove_from_GC_listing(gsurl,execute=False):
-    '''delete entry in ncsv/GC_files_{activity_id}-{institution_id}.csv'''
+    '''delete entry in the ncsv/GC_files listing (partition {activity_id}/{institution_id})'''
+    gc_files = Listings('GC_files')
     zdict = get_zdict(gsurl)
     activity_id = zdict['activity_id']
     institution_id = zdict['institution_id']
     
-    file = f'ncsv/GC_files_{activity_id}-{institution_id}.csv'
     if execute:
-        with open(file, "r") as f:
-            lines = f.readlines()
-        with open(file, "w") as f:
-            for line in lines:
-                if line.strip("\n") != gsurl + ".zmetadata":
-                    f.write(line)
+        gc_files.remove([gsurl])
     else:
-        print('modifying ',file)
+        print('modifying ',gc_files.partition_dir(activity_id, institution_id))
     return
 
 from glob import glob 
@@ -191,4 +228,92 @@ def remove_from_local_listings(gsurl,execute=False):
             dff.to_csv(file, mode='w+', index=False)
         else:
             print(f'dff.to_csv({file})')
-    return    
\ No newline at end of file
+    return    
+
+# ---- removing many stores at once ----
+# The same steps as remove_from_GC, remove_from_local and remove_from_catalogs, but each file
+# is read and written once for all the stores, and the bucket is cleaned by one gsutil call.
+
+def _write_csv(df, file):
+    '''write the csv atomically, keeping the permissions of the old file'''
+    # replacing the file works for read-only shelf listings too, no chmod u+w needed
+    write_atomic(file, lambda tmp: df.to_csv(tmp, mode='w+', index=False))
+
+def _zarr_path(zpaths):
+    # activity_id/.../grid_label of gs://cmip6/... stores or local /h*/naomi/zarr-minimal/... copies
+    return pd.Series(zpaths, dtype=object).str.split('zarr-minimal/').str[-1] \
+             .str.replace('gs://cmip6/', '', regex=False).str.strip('/').values
+
+def remove_stores_from_GC(gsurls,execute=False):
+    '''gsurls are GC zstores, use execute=False to test, execute=True to remove'''
+    gsurls = list(pd.unique(pd.Series(list(gsurls), dtype=object)))
+    command = ['/usr/bin/gsutil', '-m', 'rm', '-r', '-I']
+    if execute:
+        # the urls go to stdin, so there is no limit on how many. A failed gsutil raises
+        # CalledProcessError before the listing (and, in remove_stores, local copies and catalogs) is touched
+        subprocess.run(command, input=''.join(gsurl[:-1] + '\n' for gsurl in gsurls), text=True, check=True)
+        removed = Listings('GC_files').remove(gsurls)
+        print(f'removed {removed} stores from the GC_files listing')
+    else:
+        print(' '.join(command), f'< ({len(gsurls)} stores)')
+        gc_files = Listings('GC_files')
+        for activity_id, institution_id in sorted(set(tuple(get_zid(gsurl)[:2]) for gsurl in gsurls)):
+            print('modifying ',gc_files.partition_dir(activity_id, institution_id))
+    return
+
+def remove_stores_from_local(gsurls,execute=False):
+    '''gsurls are GC zstores, use execute=False to test, execute=True to remove'''
+    paths = set(_zarr_path(list(gsurls)))
+
+    # 3. delete old local copy(ies)
+    for path in sorted(paths):
+        for gdir in glob('/h*/naomi/zarr-minimal/' + path):
+            if execute:
+                shutil.rmtree(gdir)
+            else:
+                print('/bin/rm -rf '+ gdir)
+
+    # 4. delete entry(ies) in shelf-new/h*.csv, one rewrite per drive listing
+    file = 'shelf-new/local.csv'
+    df_local = pd.read_csv(file, dtype='unicode')
+    drop = np.isin(_zarr_path(df_local.zstore.values), list(paths))
+    if not drop.any():
+        print('zstores are not in any shelf listings')
+        return
+    zpaths = df_local.zstore[drop]
+    for ldir, zdrive in zpaths.groupby(zpaths.str.split('/').str[1]):
+        dfile = 'shelf-new/' + ldir + '.csv'
+        if not execute:
+            print(f'dff.to_csv({dfile})  # {len(zdrive)} stores')
+            continue
+        dfff = pd.read_csv(dfile, dtype='unicode')
+        _write_csv(dfff[~dfff.zstore.isin(zdrive)], dfile)
+
+    # 5. remove from concatenated catalog
+    if execute:
+        _write_csv(df_local[~drop], file)
+    else:
+        print(f'dff.to_csv({file})  # {drop.sum()} stores')
+    return
+
+def remove_stores_from_catalogs(gsurls,execute=False):
+    '''gsurls are GC zstores, use execute=False to test, execute=True to remove'''
+    date = str(datetime.datetime.now().strftime("%Y%m%d"))
+
+    cat_files = ['csv/pangeo-cmip6-noQC']
+    for cat_file in cat_files:
+        df = pd.read_csv(f'{cat_file}.csv', dtype='unicode')
+        drop = df.zstore.isin(list(gsurls))
+        if not execute:
+            print(f'{cat_file}.csv: removing {drop.sum()} of {len(df)} stores')
+            continue
+        shutil.copyfile(f'{cat_file}.csv', f'{cat_file}-'+date+'.csv')
+        _write_csv(df[~drop], f'{cat_file}.csv')
+    return
+
+def remove_stores(gsurls,execute=False):
+    '''remove the GC zstores from GC, local storage and the catalogs, use execute=False to test'''
+    remove_stores_from_GC(gsurls,execute=execute)
+    remove_stores_from_local(gsurls,execute=execute)
+    remove_stores_from_catalogs(gsurls,execute=execute)
+    return